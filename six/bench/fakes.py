@@ -0,0 +1,307 @@
+"""In-memory stand-ins for Telegram, plugged in under real clients.
+
+`FakeTelegram` answers the requests the bot makes, and `FakeSender`
+replaces a `TelegramClient`'s MTProto sender with it. Everything above
+the sender (entity resolution, request building, result parsing, the
+event handlers) is the real code, so RPC counts are the real ones.
+"""
+import asyncio
+import datetime
+import itertools
+import collections
+import typing as t
+
+from telethon import TelegramClient, errors, functions, types, utils
+
+
+class FakeSender:
+    """What `TelegramClient._call` sends through, minus the network."""
+
+    def __init__(self, world: 'FakeTelegram', client: TelegramClient):
+        self._world = world
+        self._client = client
+
+    def is_connected(self) -> bool:
+        return True
+
+    def send(self, request, ordered: bool = False):
+        if isinstance(request, list):
+            return [self.send(r) for r in request]
+
+        return asyncio.ensure_future(self._world.call(self._client, request))
+
+
+class FakeTelegram:
+    """One forum supergroup, its admins and users, as the server sees them.
+
+    Every request takes `rtt` seconds. Message IDs follow Telegram: the
+    supergroup has one sequence, and every account one for its private
+    chats.
+    """
+
+    def __init__(self, chat_id: int, rtt: float = 0.0):
+        self.rtt = rtt
+        self.calls = collections.Counter()
+        self.channel = types.Channel(id=utils.resolve_id(chat_id)[0],
+                                     title='support',
+                                     photo=types.ChatPhotoEmpty(),
+                                     date=datetime.datetime.now(),
+                                     megagroup=True,
+                                     forum=True,
+                                     access_hash=1)
+        self.users: t.Dict[int, types.User] = {}
+        self.admins: t.Set[int] = set()
+        self.topics: t.Dict[int, int] = {}  # user ID -> topic ID
+        self._counters: t.Dict[int, itertools.count] = {}
+        self._pts = itertools.count(1)
+        self._accounts: t.Dict[TelegramClient, types.User] = {}
+        # (owner, message ID) -> message; the owner of private messages is
+        # the account, and of supergroup messages the supergroup.
+        self.messages: t.Dict[t.Tuple[int, int], types.TypeMessage] = {}
+        # inline query ID -> the offset of the next page of its results
+        self.next_offsets: t.Dict[int, str] = {}
+
+    def add_user(self, user_id: int, bot: bool = False,
+                 admin: bool = False) -> types.User:
+        user = types.User(id=user_id,
+                          first_name=f'user{user_id}',
+                          access_hash=user_id,
+                          bot=bot)
+        self.users[user_id] = user
+        if admin:
+            self.admins.add(user_id)
+
+        return user
+
+    def attach(self, client: TelegramClient, user_id: int, bot: bool = False):
+        """Logs `client` in as `user_id` and makes every peer known to it."""
+        me = self.users.get(user_id) or self.add_user(user_id, bot=bot)
+        self._accounts[client] = me
+        client._sender = FakeSender(self, client)
+        client._mb_entity_cache.set_self_user(me.id, me.bot, me.access_hash)
+        self.introduce(client)
+
+    def introduce(self, client: TelegramClient):
+        users, chats = list(self.users.values()), [self.channel]
+        client._mb_entity_cache.extend(users, chats)
+        client.session.process_entities(
+            types.contacts.ResolvedPeer(None, users, chats))
+
+    def next_id(self, owner: int) -> int:
+        counter = self._counters.setdefault(owner, itertools.count(1))
+        return next(counter)
+
+    @property
+    def chat_id(self) -> int:
+        return utils.get_peer_id(types.PeerChannel(self.channel.id))
+
+    def _updates(self, updates: list) -> types.Updates:
+        return types.Updates(updates, list(self.users.values()),
+                             [self.channel], datetime.datetime.now(), 0)
+
+    def _wrap(self, message) -> types.TypeUpdate:
+        pts = next(self._pts)
+        if isinstance(message.peer_id, types.PeerChannel):
+            return types.UpdateNewChannelMessage(message, pts, 1)
+
+        return types.UpdateNewMessage(message, pts, 1)
+
+    def _wrap_edit(self, message) -> types.TypeUpdate:
+        pts = next(self._pts)
+        if isinstance(message.peer_id, types.PeerChannel):
+            return types.UpdateEditChannelMessage(message, pts, 1)
+
+        return types.UpdateEditMessage(message, pts, 1)
+
+    def _owner(self, me: types.User, peer) -> t.Tuple[int, types.TypePeer]:
+        peer = utils.get_peer(peer)
+        if isinstance(peer, types.PeerChannel):
+            return self.channel.id, peer
+
+        return me.id, peer
+
+    def _reply_header(self, owner: int, reply_to) -> t.Optional[
+            types.MessageReplyHeader]:
+        if not isinstance(reply_to, types.InputReplyToMessage):
+            return None
+
+        if owner != self.channel.id:
+            return types.MessageReplyHeader(
+                reply_to_msg_id=reply_to.reply_to_msg_id)
+
+        header = getattr(self.messages.get((owner, reply_to.reply_to_msg_id)),
+                         'reply_to', None)
+        return types.MessageReplyHeader(
+            reply_to_msg_id=reply_to.reply_to_msg_id,
+            reply_to_top_id=header and (header.reply_to_top_id
+                                        or header.reply_to_msg_id),
+            forum_topic=True)
+
+    def store(self, owner: int, message) -> types.TypeMessage:
+        self.messages[owner, message.id] = message
+        return message
+
+    async def call(self, client: TelegramClient, request):
+        self.calls[type(request).__name__] += 1
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+
+        handler = getattr(self, '_' + type(request).__name__, None)
+        if handler is None:
+            raise NotImplementedError(type(request).__name__)
+
+        return handler(self._accounts[client], request)
+
+    def _GetUsersRequest(self, me, request):
+        return [
+            me if isinstance(user, types.InputUserSelf) else
+            self.users[user.user_id] for user in request.id
+        ]
+
+    def _SendMessageRequest(self, me, request):
+        owner, peer = self._owner(me, request.peer)
+        message = self.store(
+            owner,
+            types.Message(id=self.next_id(owner),
+                          peer_id=peer,
+                          date=datetime.datetime.now(),
+                          message=request.message,
+                          out=True,
+                          from_id=types.PeerUser(me.id),
+                          reply_to=self._reply_header(owner, request.reply_to),
+                          reply_markup=request.reply_markup))
+        return self._updates([
+            types.UpdateMessageID(message.id, request.random_id),
+            self._wrap(message)
+        ])
+
+    _SendMediaRequest = _SendMessageRequest
+
+    def _SendMultiMediaRequest(self, me, request):
+        owner, peer = self._owner(me, request.peer)
+        grouped_id = next(self._pts)
+        updates = []
+        for single in request.multi_media:
+            message = self.store(
+                owner,
+                types.Message(id=self.next_id(owner),
+                              peer_id=peer,
+                              date=datetime.datetime.now(),
+                              message=single.message,
+                              out=True,
+                              from_id=types.PeerUser(me.id),
+                              reply_to=self._reply_header(
+                                  owner, request.reply_to),
+                              grouped_id=grouped_id))
+            updates += [
+                types.UpdateMessageID(message.id, single.random_id),
+                self._wrap(message)
+            ]
+
+        return self._updates(updates)
+
+    def _EditMessageRequest(self, me, request):
+        owner, _ = self._owner(me, request.peer)
+        message = self.messages.get((owner, request.id))
+        if message is None:
+            raise errors.MessageIdInvalidError(request)
+
+        if message.message == request.message:
+            raise errors.MessageNotModifiedError(request)
+
+        message.message = request.message
+        message.edit_date = datetime.datetime.now()
+        return self._updates([self._wrap_edit(message)])
+
+    def _messages(self, owner: int, ids) -> list:
+        return [
+            self.messages.get((owner, i.id)) or types.MessageEmpty(i.id)
+            for i in ids
+        ]
+
+    def _GetMessagesRequest(self, me, request):
+        if isinstance(request, functions.channels.GetMessagesRequest):
+            return types.messages.ChannelMessages(
+                pts=next(self._pts),
+                count=len(request.id),
+                messages=self._messages(self.channel.id, request.id),
+                topics=[],
+                chats=[self.channel],
+                users=list(self.users.values()))
+
+        return types.messages.Messages(self._messages(me.id, request.id),
+                                       [self.channel],
+                                       list(self.users.values()))
+
+    def _DeleteMessagesRequest(self, me, request):
+        owner = (self.channel.id if isinstance(
+            request, functions.channels.DeleteMessagesRequest) else me.id)
+        for message_id in request.id:
+            self.messages.pop((owner, message_id), None)
+
+        return types.messages.AffectedMessages(next(self._pts), 1)
+
+    def _CreateForumTopicRequest(self, me, request):
+        owner = self.channel.id
+        message = self.store(
+            owner,
+            types.MessageService(
+                id=self.next_id(owner),
+                peer_id=types.PeerChannel(owner),
+                date=datetime.datetime.now(),
+                action=types.MessageActionTopicCreate(request.title, 0),
+                from_id=types.PeerUser(me.id)))
+        self.topics[request.random_id] = message.id
+        return self._updates([
+            types.UpdateMessageID(message.id, request.random_id),
+            self._wrap(message)
+        ])
+
+    def _UpdatePinnedMessageRequest(self, me, request):
+        return self._updates([])
+
+    def _SendReactionRequest(self, me, request):
+        return self._updates([])
+
+    def _GetParticipantRequest(self, me, request):
+        user_id = request.participant.user_id
+        if user_id not in self.admins:
+            raise errors.UserNotParticipantError(request)
+
+        return types.channels.ChannelParticipant(
+            types.ChannelParticipantAdmin(user_id,
+                                          promoted_by=me.id,
+                                          date=datetime.datetime.now(),
+                                          admin_rights=types.ChatAdminRights(),
+                                          can_edit=True), [self.channel],
+            [self.users[user_id]])
+
+    def _SetInlineBotResultsRequest(self, me, request):
+        if request.next_offset:
+            self.next_offsets[request.query_id] = request.next_offset
+
+        return True
+
+    def _SetBotCallbackAnswerRequest(self, me, request):
+        return True
+
+    def _GetForumTopicsByIDRequest(self, me, request):
+        topics = []
+        for topic_id in request.topics:
+            topics.append(
+                types.ForumTopic(id=topic_id,
+                                 date=datetime.datetime.now(),
+                                 title='',
+                                 icon_color=0,
+                                 top_message=topic_id,
+                                 read_inbox_max_id=0,
+                                 read_outbox_max_id=0,
+                                 unread_count=0,
+                                 unread_mentions_count=0,
+                                 unread_reactions_count=0,
+                                 from_id=types.PeerUser(me.id),
+                                 notify_settings=types.PeerNotifySettings()))
+
+        return types.messages.ForumTopics(len(topics), topics, [], [self.channel],
+                                          list(self.users.values()),
+                                          next(self._pts))
@@ -0,0 +1,163 @@
+import time
+import asyncio
+import logging
+
+from redis.exceptions import RedisError
+from telethon import TelegramClient, errors, functions
+
+import config
+from .cache import cache
+
+logger = logging.getLogger(__name__)
+
+MEMBERS_KEY = f'admins:{config.CHAT_ID}'
+NON_MEMBER_KEY = 'admins:non-member:{}'
+
+# In-process snapshot of the support group participants, refreshed in the
+# background; `is_admin` only falls back to an RPC for unknown users.
+_members: set = set()
+_non_members: dict = {}
+_loaded_at = 0.0
+_reload = asyncio.Event()
+
+
+def _fresh() -> bool:
+    return time.monotonic() - _loaded_at < config.ADMIN_CACHE_TTL
+
+
+async def load(client: TelegramClient):
+    """Bulk loads the participants of CHAT_ID into memory and Redis."""
+    global _members, _loaded_at
+    members = {
+        user.id
+        async for user in client.iter_participants(config.CHAT_ID)
+    }
+
+    _members = members
+    _non_members.clear()
+    _loaded_at = time.monotonic()
+    async with cache.pipeline(transaction=True) as pipe:
+        pipe.delete(MEMBERS_KEY)
+        if members:
+            pipe.sadd(MEMBERS_KEY, *members)
+            pipe.expire(MEMBERS_KEY, config.ADMIN_CACHE_TTL)
+        await pipe.execute()
+
+
+async def _restore():
+    """Restores the snapshot stored by another process, if still alive."""
+    global _members, _loaded_at
+    async with cache.pipeline(transaction=False) as pipe:
+        members, ttl = await pipe.smembers(MEMBERS_KEY).ttl(
+            MEMBERS_KEY).execute()
+
+    if members and ttl > 0:
+        _members = {int(member) for member in members}
+        _loaded_at = (time.monotonic() - config.ADMIN_CACHE_TTL + ttl)
+        return True
+
+    return False
+
+
+async def refresh_forever(client: TelegramClient):
+    """Keeps the snapshot fresh until the client disconnects."""
+    try:
+        restored = await _restore()
+
+    except RedisError:
+        restored = False
+
+    if not restored:
+        _reload.set()
+
+    while client.is_connected():
+        if _reload.is_set() or not _fresh():
+            _reload.clear()
+            try:
+                await load(client)
+
+            except (errors.RPCError, RedisError):
+                logger.exception('unable to load participants of CHAT_ID')
+
+        try:
+            await asyncio.wait_for(_reload.wait(),
+                                   config.ADMIN_CACHE_REFRESH)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def is_admin(client: TelegramClient, user_id: int) -> bool:
+    """Returns whether the user takes part in CHAT_ID."""
+    if user_id in _members:
+        return True
+
+    expires = _non_members.get(user_id)
+    if expires and expires > time.monotonic():
+        return False
+
+    try:
+        async with cache.pipeline(transaction=False) as pipe:
+            member, non_member = await pipe.sismember(
+                MEMBERS_KEY, user_id).exists(
+                    NON_MEMBER_KEY.format(user_id)).execute()
+
+    except RedisError:
+        logger.warning('redis is unavailable, asking about %d', user_id)
+        member = non_member = False
+
+    if member:
+        _members.add(user_id)
+        return True
+
+    if non_member:
+        result = False
+
+    else:
+        try:
+            await client(
+                functions.channels.GetParticipantRequest(
+                    config.CHAT_ID, participant=user_id))
+        except errors.RPCError:
+            result = False
+
+        else:
+            result = True
+
+    await _remember(user_id, result)
+    return result
+
+
+async def _remember(user_id: int, member: bool):
+    if member:
+        _members.add(user_id)
+        _non_members.pop(user_id, None)
+
+    else:
+        _members.discard(user_id)
+        _non_members[user_id] = (time.monotonic() +
+                                 config.ADMIN_NEGATIVE_CACHE_TTL)
+
+    try:
+        async with cache.pipeline(transaction=False) as pipe:
+            if member:
+                pipe.sadd(MEMBERS_KEY, user_id)
+                pipe.delete(NON_MEMBER_KEY.format(user_id))
+
+            else:
+                pipe.srem(MEMBERS_KEY, user_id)
+                pipe.setex(NON_MEMBER_KEY.format(user_id),
+                           config.ADMIN_NEGATIVE_CACHE_TTL, 1)
+
+            await pipe.execute()
+
+    except RedisError:
+        logger.warning('redis is unavailable, %d is only known here', user_id)
+
+
+async def participants_changed(event):
+    """Applies a join/leave action to the snapshot and schedules a reload."""
+    user_ids = [user.id for user in event.users] or [event.user_id]
+    for user_id in filter(None, user_ids):
+        await _remember(user_id, event.user_joined or event.user_added)
+
+    _reload.set()
@@ -0,0 +1,53 @@
+import asyncio
+import itertools
+import logging
+import typing as t
+
+import config
+
+logger = logging.getLogger(__name__)
+
+Flush = t.Callable[[t.List[t.Any]], t.Awaitable]
+
+# conversation key -> the new message events held back for it so far
+_gathering: t.Dict[t.Hashable, t.List[t.Any]] = {}
+
+
+async def _close(key: t.Hashable, flush: Flush):
+    await asyncio.sleep(config.ALBUM_WINDOW)
+    gathered = _gathering.pop(key)
+    try:
+        await flush(gathered)
+
+    except Exception:
+        logger.exception('could not relay the messages gathered for %s', key)
+
+
+def gather(key: t.Hashable, event, flush: Flush) -> bool:
+    """Holds `event` back while an album of its conversation is gathered.
+
+    The parts of an album arrive as separate messages, normally right
+    after each other. The first part opens an ALBUM_WINDOW seconds long
+    window, and every message of the conversation within it (album or
+    not, to keep their order) is handed to `flush` once it closes.
+
+    Returns False, leaving `event` alone, if there is nothing to gather.
+    """
+    gathered = _gathering.get(key)
+    if gathered is None:
+        if event.message.grouped_id is None:
+            return False
+
+        gathered = _gathering[key] = []
+        asyncio.ensure_future(_close(key, flush))
+
+    gathered.append(event)
+    return True
+
+
+def split(events: t.List[t.Any]) -> t.List[t.List[t.Any]]:
+    """Splits gathered events into albums and single messages, in order."""
+    return [
+        list(group) for _, group in itertools.groupby(
+            events, lambda e: e.message.grouped_id or -e.message.id)
+    ]
@@ -0,0 +1,203 @@
+import time
+import asyncio
+import logging
+import typing as t
+
+from redis.exceptions import LockError, RedisError
+from telethon import errors
+
+import config
+from . import storage
+from .cache import cache
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = 'broadcast'
+LOCK_KEY = 'broadcast:lock'
+COUNTS = ('sent', 'failed', 'skipped')
+
+# Users that can't be written to anymore; they are skipped, not failed.
+UNREACHABLE = (errors.UserIsBlockedError, errors.YouBlockedUserError,
+               errors.InputUserDeactivatedError, errors.UserDeactivatedError,
+               errors.UserDeactivatedBanError, errors.PeerIdInvalidError)
+
+Send = t.Callable[[int], t.Awaitable]
+Prepare = t.Callable[[int, int], t.Awaitable[t.Optional[Send]]]
+Report = t.Callable[[int, int, dict], t.Awaitable]
+
+
+class _Pace:
+    """Spaces calls out to at most `rate` a second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next = time.monotonic()
+
+    async def wait(self):
+        now = time.monotonic()
+        at = max(self.next, now)
+        self.next = at + self.interval
+        await asyncio.sleep(at - now)
+
+
+async def active() -> bool:
+    return bool(await cache.exists(STATE_KEY))
+
+
+async def start(chat_id: int, message_id: int, report_id: int) -> bool:
+    """Queues a broadcast of a message; False if one is queued already.
+
+    `report_id` is the message in `chat_id` that progress is edited into.
+    """
+    total = await storage.run(storage.Users.select().count)
+    if not await cache.hsetnx(STATE_KEY, 'message_id', message_id):
+        return False
+
+    await cache.hset(STATE_KEY,
+                     mapping={
+                         'chat_id': chat_id,
+                         'report_id': report_id,
+                         'total': total,
+                         'last_id': 0,
+                         'started': time.time(),
+                         **dict.fromkeys(COUNTS, 0)
+                     })
+    return True
+
+
+async def cancel():
+    await cache.delete(STATE_KEY)
+
+
+def _progress(state: dict, counts: dict, error: t.Optional[str] = None,
+              done: bool = False) -> dict:
+    """Returns what `Report` gets: the counts, users a second since this
+    process took over, and why it stopped early ('gone', 'cancelled' or
+    'flood') if it did."""
+    return {
+        'total': int(state['total']),
+        **counts,
+        'rate': (sum(counts.values()) - state['resumed_at']) /
+        max(time.monotonic() - state['resumed'], 1),
+        'elapsed': time.time() - float(state['started']),
+        'error': error,
+        'done': done,
+    }
+
+
+async def _report_forever(state: dict, counts: dict, lock, report: Report):
+    while True:
+        await asyncio.sleep(config.BROADCAST_REPORT_INTERVAL)
+        try:
+            await lock.reacquire()
+
+        except (LockError, RedisError):
+            logger.warning('could not hold on to the broadcast lock')
+
+        try:
+            await report(int(state['chat_id']), int(state['report_id']),
+                         _progress(state, counts))
+
+        except errors.RPCError:
+            logger.warning('could not report the progress of a broadcast')
+
+
+async def _send(send: Send, user_id: int, counts: dict, pool: asyncio.Semaphore,
+                pace: _Pace):
+    async with pool:
+        await pace.wait()
+        try:
+            await send(user_id)
+            counts['sent'] += 1
+
+        except UNREACHABLE:
+            counts['skipped'] += 1
+
+        except errors.PeerFloodError:
+            raise  # Telegram's spam limit, going on only makes it worse
+
+        except errors.RPCError as error:
+            logger.warning('broadcast to %d failed: %s', user_id, error)
+            counts['failed'] += 1
+
+
+async def run(prepare: Prepare, report: Report):
+    """Sends the queued broadcast, if any, from where it was left off.
+
+    Users are read BROADCAST_CHUNK at a time, in ID order, and the last
+    ID of every finished chunk is checkpointed with the counts, so after
+    a restart at most one chunk is sent again. A Redis lock keeps other
+    processes from sending the same broadcast.
+    """
+    lock = cache.lock(LOCK_KEY, timeout=3 * config.BROADCAST_REPORT_INTERVAL)
+    if not await lock.acquire(blocking=False):
+        return
+
+    try:
+        state = await cache.hgetall(STATE_KEY)
+        if not state:
+            return
+
+        chat_id, report_id = int(state['chat_id']), int(state['report_id'])
+        counts = {count: int(state[count]) for count in COUNTS}
+        state['resumed'] = time.monotonic()
+        state['resumed_at'] = sum(counts.values())
+        send = await prepare(chat_id, int(state['message_id']))
+        error = None if send is not None else 'gone'
+        reporter = asyncio.ensure_future(
+            _report_forever(state, counts, lock, report))
+        pool = asyncio.Semaphore(config.BROADCAST_CONCURRENCY)
+        pace = _Pace(config.BROADCAST_RATE)
+        last_id = int(state['last_id'])
+        try:
+            while send is not None:
+                users = await storage.run(storage.users_after, last_id,
+                                          config.BROADCAST_CHUNK)
+                if not users:
+                    break
+
+                tasks = [
+                    asyncio.ensure_future(
+                        _send(send, user.user_id, counts, pool, pace))
+                    for user in users
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+
+                    raise
+
+                last_id = users[-1].id
+                if not await active():
+                    error = 'cancelled'
+                    break
+
+                await cache.hset(STATE_KEY,
+                                 mapping={
+                                     'last_id': last_id,
+                                     **counts
+                                 })
+
+        except errors.PeerFloodError:
+            error = 'flood'
+
+        finally:
+            reporter.cancel()
+
+        await cancel()
+        try:
+            await report(chat_id, report_id,
+                         _progress(state, counts, error, done=True))
+
+        except errors.RPCError:
+            logger.warning('could not report the end of a broadcast')
+
+    finally:
+        try:
+            await lock.release()
+
+        except LockError:
+            pass
@@ -1,20 +1,143 @@
-import redis.asyncio
-from .enums import Status
-
-
-
-cache  = redis.asyncio.Redis(host='redis', decode_responses=True)
-
-async def get_user_status(user_id: int):
-    status = await cache.get(f'user_status:{user_id}')
-    if status:
-        return Status(status)
-    
-    else:
-        return Status.NULL
-
-async def set_user_status(user_id: int, status: Status):
-    await cache.set(f'user_status:{user_id}', status.value)
-
-
-    
\ No newline at end of file
+import os
+import time
+import asyncio
+import logging
+import typing as t
+
+import redis.asyncio
+from redis.exceptions import RedisError
+
+import config
+from . import metrics
+from .enums import Status
+from .lru import LRU
+
+logger = logging.getLogger(__name__)
+
+pool = redis.asyncio.ConnectionPool.from_url(
+    config.REDIS_URL,
+    max_connections=config.REDIS_MAX_CONNECTIONS,
+    socket_timeout=config.REDIS_TIMEOUT,
+    socket_connect_timeout=config.REDIS_TIMEOUT,
+    health_check_interval=30,
+    decode_responses=True)
+
+
+
+class _Pipeline(redis.asyncio.client.Pipeline):
+
+    async def execute(self, *args, **kwargs):
+        with metrics.redis_seconds.time('PIPELINE'):
+            return await super().execute(*args, **kwargs)
+
+
+class _Redis(redis.asyncio.Redis):
+    """Times every round-trip in `metrics`, a pipeline counting as one."""
+
+    async def execute_command(self, *args, **options):
+        with metrics.redis_seconds.time(str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return _Pipeline(self.connection_pool, self.response_callbacks,
+                         transaction, shard_hint)
+
+
+cache = _Redis(connection_pool=pool)
+
+# Small in-process layer in front of Redis: key -> (expires, value). Other
+# processes announce their writes on INVALIDATE_CHANNEL so it stays
+# coherent, and it keeps answering (stale or not) while Redis is down.
+INVALIDATE_CHANNEL = 'cache:invalidate'
+_origin = f'{os.getpid()}:{id(pool)}'
+_local = LRU(config.LOCAL_CACHE_SIZE)
+# Called with the keys other processes write, None standing for all of
+# them, by state kept in memory outside `_local`
+_listeners: t.List[t.Callable[[t.Optional[str]], None]] = []
+
+
+def on_invalidate(listener: t.Callable[[t.Optional[str]], None]):
+    _listeners.append(listener)
+    return listener
+
+
+def announce(pipe: redis.asyncio.client.Pipeline, key: str):
+    """Adds telling the other processes that `key` changed to `pipe`."""
+    pipe.publish(INVALIDATE_CHANNEL, f'{_origin} {key}')
+
+
+async def get(key: str) -> t.Optional[str]:
+    entry = _local.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+
+    try:
+        value = await cache.get(key)
+
+    except RedisError:
+        logger.warning('redis is unavailable, serving %s from memory', key)
+        return entry[1] if entry else None
+
+    _local.put(key, (time.monotonic() + config.LOCAL_CACHE_TTL, value))
+    return value
+
+
+async def put(key: str, value: str, ex: t.Optional[int] = None):
+    _local.put(key, (time.monotonic() + min(ex or config.LOCAL_CACHE_TTL,
+                                            config.LOCAL_CACHE_TTL), value))
+    try:
+        async with cache.pipeline(transaction=False) as pipe:
+            pipe.set(key, value, ex=ex)
+            announce(pipe, key)
+            await pipe.execute()
+
+    except RedisError:
+        logger.warning('redis is unavailable, %s is only set in memory', key)
+
+
+def _expire_all():
+    """Has `get` ask Redis again, falling back on the entries if it fails."""
+    for key, (_, value) in _local.items():
+        _local[key] = 0.0, value
+
+
+async def listen_forever():
+    """Drops local entries other processes have just written."""
+    dropped = False
+    while True:
+        try:
+            async with cache.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                if dropped:
+                    # Writes made meanwhile went unheard, but until now the
+                    # local entries were all there was to serve.
+                    dropped = False
+                    _expire_all()
+                    for listener in _listeners:
+                        listener(None)
+
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+
+                    origin, key = message['data'].split(' ', 1)
+                    if origin != _origin:
+                        _local.discard(key)
+                        for listener in _listeners:
+                            listener(key)
+
+        except RedisError:
+            dropped = True
+            await asyncio.sleep(config.REDIS_TIMEOUT)
+
+
+async def get_user_status(user_id: int):
+    status = await get(f'user_status:{user_id}')
+    if status:
+        return Status(status)
+
+    else:
+        return Status.NULL
+
+async def set_user_status(user_id: int, status: Status):
+    await put(f'user_status:{user_id}', status.value)
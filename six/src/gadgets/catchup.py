@@ -0,0 +1,192 @@
+import time
+import asyncio
+import logging
+import datetime
+import typing as t
+
+from redis.exceptions import RedisError
+from telethon import TelegramClient, errors
+from telethon.tl.custom import Message
+
+import config
+from . import cache as cache_layer
+from .cache import cache
+from .dispatcher import dispatcher
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_KEY = 'catch-up:heartbeat'
+HOLD_KEY = 'catch-up:hold'
+UNTIL_KEY = 'catch-up:until'  # when the last catching up read up to
+
+
+async def hold():
+    """Holds back live updates, here and in the other workers, until `run`
+    has caught up.
+
+    Called before the clients start, so nothing is dispatched before it.
+    """
+    dispatcher.hold()
+    try:
+        await cache.set(HOLD_KEY, 1, ex=config.CATCHUP_HOLD_TIMEOUT)
+
+    except RedisError:
+        logger.warning('redis is unavailable, not holding the other workers')
+
+
+async def held() -> bool:
+    """Returns whether workers have to wait for catching up to finish."""
+    return bool(await cache.exists(HOLD_KEY))
+
+
+async def _release():
+    dispatcher.release()
+    try:
+        await cache.delete(HOLD_KEY)
+
+    except RedisError:
+        logger.warning('redis is unavailable, workers wait for the hold to '
+                       'expire')
+
+
+async def last_seen() -> t.Optional[datetime.datetime]:
+    """Returns when a live process last beat, if one ever did."""
+    value = await cache.get(HEARTBEAT_KEY)
+    if value is None:
+        return None
+
+    return datetime.datetime.fromtimestamp(float(value), datetime.timezone.utc)
+
+
+async def heartbeat_forever():
+    while True:
+        try:
+            await cache.set(HEARTBEAT_KEY, time.time())
+
+        except RedisError:
+            logger.warning('redis is unavailable, skipping a heartbeat')
+
+        await asyncio.sleep(config.CATCHUP_HEARTBEAT)
+
+
+async def overlaps(date: datetime.datetime) -> bool:
+    """Returns whether a live message may have been caught up on already.
+
+    The updates held back while catching up are in the history it reads
+    too, up to a second past its end since message dates are truncated.
+    """
+    until = await cache_layer.get(UNTIL_KEY)
+    return until is not None and date < datetime.datetime.fromtimestamp(
+        float(until) + 1, datetime.timezone.utc)
+
+
+async def _patiently(iterator: t.AsyncIterator) -> t.AsyncIterator:
+    """Iterates over a Telethon request iterator, sitting out FloodWaits.
+
+    The clients don't sleep on them themselves (see main.py); asked for
+    its next item again, the iterator requests the same chunk again.
+    """
+    while True:
+        try:
+            item = await iterator.__anext__()
+
+        except StopAsyncIteration:
+            return
+
+        except errors.FloodWaitError as error:
+            logger.warning('FloodWait of %ds while catching up', error.seconds)
+            await asyncio.sleep(error.seconds + 1)
+            continue
+
+        yield item
+
+
+async def missed_private(
+        client: TelegramClient, since: datetime.datetime,
+        until: datetime.datetime) -> t.Dict[int, t.List[Message]]:
+    """Returns what users wrote to `client` in [since, until), per user.
+
+    Dialogs come newest first, so listing stops at the first one (pinned
+    ones aside) that has been quiet since `since`.
+    """
+    missed = {}
+    async for dialog in _patiently(client.iter_dialogs()):
+        if dialog.date < since and not dialog.pinned:
+            break
+
+        user = dialog.entity
+        if not dialog.is_user or user.bot or user.is_self:
+            continue
+
+        messages = [
+            message async for message in _patiently(
+                client.iter_messages(user, offset_date=since, reverse=True))
+            if message.date < until and not message.out
+            and message.action is None
+        ]
+        if messages:
+            missed[user.id] = messages
+
+    return missed
+
+
+async def missed_group(client: TelegramClient, since: datetime.datetime,
+                       until: datetime.datetime,
+                       own_ids: t.Set[int]) -> t.Dict[int, t.List[Message]]:
+    """Returns what admins wrote in the topics of CHAT_ID, per topic."""
+    missed = {}
+    async for message in _patiently(
+            client.iter_messages(config.CHAT_ID,
+                                 offset_date=since,
+                                 reverse=True)):
+        if message.date >= until:
+            break
+
+        reply_to = message.reply_to
+        if (message.action is not None or message.sender_id in own_ids
+                or reply_to is None or not reply_to.forum_topic):
+            continue
+
+        topic_id = reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+        missed.setdefault(topic_id, []).append(message)
+
+    return missed
+
+
+async def run(relay: t.Callable[[datetime.datetime, datetime.datetime],
+                                t.Awaitable]):
+    """Hands `relay` the time the bot was away, then keeps the heartbeat.
+
+    The first start has nothing to catch up on, and a longer absence
+    than CATCHUP_MAX_AGE is cut short rather than flooding the topics.
+    Live updates held back by `hold` go once `relay` is done; `relay`
+    may let the local ones go earlier with `dispatcher.release`.
+    """
+    until = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        since = await last_seen()
+
+    except RedisError:
+        logger.warning('redis is unavailable, not catching up')
+        since = None
+
+    try:
+        if since is not None:
+            oldest = until - datetime.timedelta(seconds=config.CATCHUP_MAX_AGE)
+            if since < oldest:
+                logger.warning('down since %s, catching up from %s', since,
+                               oldest)
+                since = oldest
+
+            await cache_layer.put(UNTIL_KEY,
+                                  until.timestamp(),
+                                  ex=config.CATCHUP_MAX_AGE)
+            await relay(since, until)
+
+    except Exception:
+        logger.exception('catching up failed')
+
+    finally:
+        await _release()
+
+    await heartbeat_forever()
@@ -0,0 +1,126 @@
+import asyncio
+import functools
+import typing as t
+from collections import deque
+
+import config
+
+
+class Dispatcher:
+    """Runs jobs in submission order per key on a bounded pool of workers.
+
+    Jobs sharing a key (a user) never overlap and run in the order they
+    were submitted, while different keys run in parallel on at most
+    `workers` tasks. `submit` waits while the key already has `depth`
+    jobs queued, or while `limit` jobs are pending in total, and while
+    the dispatcher is on hold.
+    """
+
+    def __init__(self, workers: int, depth: int, limit: int):
+        self.workers = workers
+        self.depth = depth
+        self.limit = limit
+        self.pending = 0
+        self._queues: t.Dict[t.Hashable, deque] = {}
+        self._ready: t.Optional[asyncio.Queue] = None
+        self._space: t.Optional[asyncio.Condition] = None
+        self._tasks: t.List[asyncio.Task] = []
+        self._open = asyncio.Event()
+        self._open.set()
+
+    def _start(self):
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Condition()
+        self._tasks = [
+            asyncio.ensure_future(self._work()) for _ in range(self.workers)
+        ]
+
+    def hold(self):
+        """Keeps `submit` from queueing anything until `release`."""
+        self._open.clear()
+
+    def release(self):
+        self._open.set()
+
+    async def submit(self, key: t.Hashable, job: t.Callable[[], t.Awaitable]):
+        """Queues `job` behind the other jobs of `key` and waits for it."""
+        await self._open.wait()
+        if self._ready is None:
+            self._start()
+
+        async with self._space:
+            await self._space.wait_for(lambda: self.pending < self.limit and len(
+                self._queues.get(key, ())) < self.depth)
+
+        return await self.enqueue(key, job)
+
+    def enqueue(self, key: t.Hashable,
+                job: t.Callable[[], t.Awaitable]) -> asyncio.Future:
+        """Queues `job` right away, hold and limits aside; returns its future.
+
+        For jobs that must go before whatever `submit` is holding back.
+        """
+        if self._ready is None:
+            self._start()
+
+        self.pending += 1
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ready.put_nowait(key)
+
+        queue.append((job, future))
+        return future
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            job, future = queue[0]
+            try:
+                if not future.cancelled():
+                    future.set_result(await job())
+
+            except BaseException as error:
+                # Jobs get cancelled too, e.g. by a disconnect; only the
+                # cancellation of the worker itself may end it.
+                if not future.cancelled():
+                    future.set_exception(error)
+
+                if asyncio.current_task().cancelling():
+                    raise
+
+            finally:
+                queue.popleft()
+                if queue:
+                    # Back of the line, so one busy user can't starve the rest.
+                    self._ready.put_nowait(key)
+
+                else:
+                    del self._queues[key]
+
+                async with self._space:
+                    self.pending -= 1
+                    self._space.notify_all()
+
+    def ordered(self, key: t.Callable[[t.Any], t.Hashable]):
+        """Decorates an event handler so it runs through the dispatcher.
+
+        Telethon awaits each handler before the next one for the same
+        update, so a chain of decorated handlers keeps its order too.
+        """
+
+        def decorator(handler):
+
+            @functools.wraps(handler)
+            async def wrapper(event):
+                return await self.submit(key(event), lambda: handler(event))
+
+            return wrapper
+
+        return decorator
+
+
+dispatcher = Dispatcher(config.DISPATCH_WORKERS, config.DISPATCH_QUEUE_DEPTH,
+                        config.DISPATCH_MAX_PENDING)
@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+import logging
+import typing as t
+
+from redis.exceptions import RedisError
+from telethon import errors
+
+import config
+from .cache import cache
+
+logger = logging.getLogger(__name__)
+
+HASH_KEY = 'edit-hash:{}:{}:{}'
+
+Apply = t.Callable[[str], t.Awaitable]
+
+# (kind, chat ID, message ID) -> (the latest value waiting to be mirrored
+# there, how to, what the message holds if nothing was mirrored yet), or
+# None while the previous one is being sent
+_pending: t.Dict[t.Tuple[str, int, int], t.Optional[t.Tuple[
+    str, Apply, t.Optional[str]]]] = {}
+_flushes: t.Set[asyncio.Task] = set()
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+async def _send(key: t.Tuple[str, int, int], value: str, apply: Apply,
+                assumed: t.Optional[str]):
+    hash_key = HASH_KEY.format(*key)
+    digest = _digest(value)
+    try:
+        mirrored = await cache.get(hash_key)
+        if mirrored == digest or (mirrored is None and value == assumed):
+            return  # already there, e.g. an edit undone within the window
+
+    except RedisError:
+        logger.warning('redis is unavailable, mirroring %s regardless', key)
+
+    try:
+        await apply(value)
+
+    except errors.MessageNotModifiedError:
+        pass
+
+    except Exception:
+        logger.exception('could not mirror an edit to %s', key)
+        return
+
+    try:
+        await cache.set(hash_key, digest, ex=config.EDIT_HASH_TTL)
+
+    except RedisError:
+        logger.warning('redis is unavailable, not remembering %s', key)
+
+
+async def _flush(key: t.Tuple[str, int, int]):
+    while True:
+        await asyncio.sleep(config.EDIT_DEBOUNCE)
+        pending = _pending.get(key)
+        if pending is None:
+            return  # discarded
+
+        _pending[key] = None
+        await _send(key, *pending)
+        if _pending.get(key) is None:
+            _pending.pop(key, None)
+            return
+
+
+def mirror(chat_id: int,
+           message_id: int,
+           value: str,
+           apply: Apply,
+           kind: str = 'text',
+           assumed: t.Optional[str] = None):
+    """Has `apply` mirror `value` to a message once its edits settle.
+
+    Edits of one `kind` made within EDIT_DEBOUNCE seconds of each other
+    replace one another, so a burst of them costs a single `apply`, which
+    is skipped altogether when the value is the one mirrored last (or
+    `assumed`, if none was).
+    """
+    key = kind, chat_id, message_id
+    if key not in _pending:
+        task = asyncio.ensure_future(_flush(key))
+        _flushes.add(task)
+        task.add_done_callback(_flushes.discard)
+
+    _pending[key] = value, apply, assumed
+
+
+def discard(chat_id: int, message_ids: t.Iterable[int]):
+    """Drops the edits waiting for messages that are going away."""
+    targets = {(chat_id, message_id) for message_id in message_ids}
+    for key in [key for key in _pending if key[1:] in targets]:
+        del _pending[key]
+
+
+async def settle():
+    """Waits until every pending edit has been mirrored."""
+    while _flushes:
+        await asyncio.gather(*_flushes)
@@ -1,8 +1,15 @@
-from enum import Enum, auto
-
-
-class Status(Enum):
-    NULL = 'NULL'
-    INPUT_MESSAGE = 'INPUT_MESSAGE'
-
+from enum import Enum, auto
+
+
+class Status(Enum):
+    NULL = 'NULL'
+    INPUT_MESSAGE = 'INPUT_MESSAGE'
+    INPUT_BROADCAST = 'INPUT_BROADCAST'
+
+
+class TopicState(Enum):
+    OPEN = 'OPEN'
+    CLOSED = 'CLOSED'
+    DELETED = 'DELETED'
+
     
\ No newline at end of file
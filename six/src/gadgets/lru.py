@@ -0,0 +1,29 @@
+import typing as t
+from collections import OrderedDict
+
+
+class LRU(OrderedDict):
+    """A bounded mapping that evicts the least recently used keys."""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+
+        except KeyError:
+            return default
+
+        self.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def discard(self, key) -> t.Any:
+        return self.pop(key, None)
@@ -0,0 +1,197 @@
+import json
+import asyncio
+import typing as t
+
+from telethon import TelegramClient, types
+
+import config
+from . import metrics
+from .lru import LRU
+from .cache import cache
+
+PART_SIZE = 512 * 1024
+CACHE_KEY = 'media:{}:{}'
+
+# (sender, source media ID) -> media as `sender` sees it, in front of Redis
+_sent = LRU(config.MEDIA_CACHE_SIZE)
+
+# Bounds how many transfers run at once; each one holds at most
+# MEDIA_RELAY_BUFFER_PARTS parts in memory.
+_budget = asyncio.Semaphore(config.MEDIA_RELAY_CONCURRENCY)
+
+
+class _Pipe:
+    """A read-only file whose bytes come straight from a running download.
+
+    `TelegramClient.upload_file` reads it part by part while a background
+    task keeps at most MEDIA_RELAY_BUFFER_PARTS downloaded parts queued.
+    """
+
+    def __init__(self, client: TelegramClient, document: types.Document,
+                 name: str):
+        self.name = name
+        self._eof = False
+        self._buffer = bytearray()
+        self._queue = asyncio.Queue(config.MEDIA_RELAY_BUFFER_PARTS)
+        self._task = asyncio.ensure_future(self._download(client, document))
+
+    async def _download(self, client: TelegramClient,
+                        document: types.Document):
+        try:
+            async for chunk in client.iter_download(document,
+                                                    request_size=PART_SIZE):
+                await self._queue.put(chunk)
+
+        except Exception as error:
+            await self._queue.put(error)
+
+        else:
+            await self._queue.put(None)
+
+    async def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = await self._queue.get()
+            if chunk is None:
+                self._eof = True
+
+            elif isinstance(chunk, Exception):
+                raise chunk
+
+            else:
+                self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+
+        part = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return part
+
+    def close(self):
+        self._task.cancel()
+
+
+async def relay(source: TelegramClient, sender: TelegramClient,
+                message: types.Message) -> t.Optional[types.TypeInputMedia]:
+    """Moves the media of a message seen by `source` over to `sender`.
+
+    Nothing touches the disk: photos are small enough to be held in
+    memory, and documents are streamed from download to upload parts.
+    """
+    if message.file is None or message.file.size is None:
+        return None
+
+    if message.file.size > config.MEDIA_RELAY_MAX_SIZE:
+        return None
+
+    async with _budget:
+        metrics.media_bytes.inc(amount=message.file.size)
+        if isinstance(message.media, types.MessageMediaPhoto):
+            data = await source.download_media(message.media, file=bytes)
+            handle = await sender.upload_file(data, file_name='photo.jpg')
+            return types.InputMediaUploadedPhoto(handle)
+
+        document = message.media.document
+        name = message.file.name or f'file{message.file.ext or ""}'
+        pipe = _Pipe(source, document, name)
+        try:
+            handle = await sender.upload_file(pipe,
+                                              file_size=document.size,
+                                              file_name=name,
+                                              part_size_kb=PART_SIZE // 1024)
+        finally:
+            pipe.close()
+
+        return types.InputMediaUploadedDocument(
+            file=handle,
+            mime_type=document.mime_type,
+            attributes=document.attributes)
+
+
+async def reuse(client: TelegramClient, chat: int,
+                message_id: int) -> t.Optional[types.TypeMessageMedia]:
+    """Returns the media of a message `client` can already see itself.
+
+    Sending it back by reference costs a single lookup and no transfer.
+    """
+    message = await client.get_messages(chat, ids=message_id)
+    if message is not None and isinstance(
+            message.media,
+        (types.MessageMediaPhoto, types.MessageMediaDocument)):
+        return message.media
+
+    return None
+
+
+def _source_id(message: types.Message) -> t.Optional[int]:
+    if isinstance(message.media, types.MessageMediaPhoto):
+        return message.media.photo.id
+
+    if isinstance(message.media, types.MessageMediaDocument):
+        return message.media.document.id
+
+
+async def cached(sender: TelegramClient, message: types.Message):
+    """Returns the media `sender` already uploaded for the same file.
+
+    Photo and document IDs are global, so they identify a file no matter
+    which account saw it; the access hash and file reference are not,
+    hence one entry per sending client.
+    """
+    source_id = _source_id(message)
+    if source_id is None:
+        return None
+
+    me = await sender.get_me(input_peer=True)
+    key = CACHE_KEY.format(me.user_id, source_id)
+    value = _sent.get(key)
+    if value is None:
+        value = await cache.get(key)
+        if value is None:
+            return None
+
+        value = json.loads(value)
+        _sent.put(key, value)
+
+    await cache.expire(key, config.MEDIA_CACHE_TTL)
+    kind, media_id, access_hash, file_reference = value
+    if kind == 'photo':
+        return types.InputMediaPhoto(
+            types.InputPhoto(media_id, access_hash,
+                             bytes.fromhex(file_reference)))
+
+    return types.InputMediaDocument(
+        types.InputDocument(media_id, access_hash,
+                            bytes.fromhex(file_reference)))
+
+
+async def remember(sender: TelegramClient, message: types.Message,
+                   sent: types.Message):
+    """Stores the media of `sent` as the upload of `message`'s file."""
+    source_id = _source_id(message)
+    if source_id is None:
+        return
+
+    if isinstance(sent.media, types.MessageMediaPhoto):
+        item = sent.media.photo
+        kind = 'photo'
+
+    elif isinstance(sent.media, types.MessageMediaDocument):
+        item = sent.media.document
+        kind = 'document'
+
+    else:
+        return
+
+    me = await sender.get_me(input_peer=True)
+    key = CACHE_KEY.format(me.user_id, source_id)
+    value = [kind, item.id, item.access_hash, item.file_reference.hex()]
+    _sent.put(key, value)
+    await cache.setex(key, config.MEDIA_CACHE_TTL, json.dumps(value))
+
+
+async def forget(sender: TelegramClient, message: types.Message):
+    me = await sender.get_me(input_peer=True)
+    key = CACHE_KEY.format(me.user_id, _source_id(message))
+    _sent.discard(key)
+    await cache.delete(key)
@@ -0,0 +1,259 @@
+import sys
+import time
+import bisect
+import asyncio
+import functools
+import threading
+import collections
+import typing as t
+from urllib.parse import urlsplit, parse_qs
+
+from telethon import TelegramClient, events
+
+import config
+
+LATENCY_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+                   30, 60)
+
+_metrics: t.List['_Metric'] = []
+
+
+class _Metric:
+
+    def __init__(self, kind: str, name: str, documentation: str,
+                 labels: t.Tuple[str, ...]):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        # Observations come from the storage threads too.
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _label_text(self, values: tuple, extra: str = '') -> str:
+        pairs = [
+            f'{label}="{value}"' for label, value in zip(self.labels, values)
+        ]
+        if extra:
+            pairs.append(extra)
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> t.List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}'
+        ]
+
+
+class Counter(_Metric):
+
+    def __init__(self, name: str, documentation: str,
+                 labels: t.Tuple[str, ...] = ()):
+        super().__init__('counter', name, documentation, labels)
+        self._values = collections.defaultdict(float)
+
+    def inc(self, *values, amount: float = 1):
+        with self._lock:
+            self._values[values] += amount
+
+    def render(self) -> t.List[str]:
+        lines = super().render()
+        with self._lock:
+            for values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{self._label_text(values)} {value}')
+
+        return lines
+
+
+class Histogram(_Metric):
+
+    def __init__(self, name: str, documentation: str,
+                 labels: t.Tuple[str, ...] = (),
+                 buckets: t.Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__('histogram', name, documentation, labels)
+        self.buckets = buckets
+        # label values -> [count per bucket (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, *values, amount: float):
+        with self._lock:
+            entry = self._values.get(values)
+            if entry is None:
+                entry = self._values[values] = [[0] * (len(self.buckets) + 1),
+                                                0.0]
+
+            entry[0][bisect.bisect_left(self.buckets, amount)] += 1
+            entry[1] += amount
+
+    def count(self) -> int:
+        """Returns how many observations were made, across all labels."""
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._values.values())
+
+    def time(self, *values):
+        """Returns a context manager observing the time spent in it."""
+        return _Timer(self, values)
+
+    def render(self) -> t.List[str]:
+        lines = super().render()
+        with self._lock:
+            for values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip((*self.buckets, '+Inf'), counts):
+                    cumulative += count
+                    labels = self._label_text(values, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+                labels = self._label_text(values)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+
+        return lines
+
+
+class _Timer:
+
+    def __init__(self, histogram: Histogram, values: tuple):
+        self._histogram = histogram
+        self._values = values
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(*self._values,
+                                amount=time.perf_counter() - self._start)
+
+
+handler_seconds = Histogram('handler_seconds',
+                            'Time spent in each event handler.',
+                            ('handler', ))
+handler_errors = Counter('handler_errors_total',
+                         'Event handlers that raised.', ('handler', ))
+rpc_seconds = Histogram('rpc_seconds',
+                        'Outbound RPCs by client and method.',
+                        ('client', 'method'))
+rpc_errors = Counter('rpc_errors_total', 'Outbound RPCs that failed.',
+                     ('client', 'method', 'error'))
+flood_wait_seconds = Counter('flood_wait_seconds_total',
+                             'Seconds Telegram asked each client to wait.',
+                             ('client', ))
+db_query_seconds = Histogram('db_query_seconds', 'SQL statements by kind.',
+                             ('statement', ))
+redis_seconds = Histogram('redis_seconds', 'Redis round-trips by command.',
+                          ('command', ))
+media_copies = Counter('media_copies_total',
+                       'Media copied between chats, by how it got there.',
+                       ('path', ))
+media_bytes = Counter('media_bytes_total',
+                      'Media bytes downloaded and uploaded again by relays.')
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    return '\n'.join(lines) + '\n'
+
+
+def _timed_handler(callback):
+
+    @functools.wraps(callback)
+    async def wrapper(event):
+        start = time.perf_counter()
+        try:
+            return await callback(event)
+
+        except events.StopPropagation:
+            raise
+
+        except Exception:
+            handler_errors.inc(callback.__name__)
+            raise
+
+        finally:
+            handler_seconds.observe(callback.__name__,
+                                    amount=time.perf_counter() - start)
+
+    return wrapper
+
+
+def instrument(client: TelegramClient):
+    """Times every handler registered on `client`, keeping their order."""
+    handlers = client.list_event_handlers()
+    for callback, _ in handlers:
+        client.remove_event_handler(callback)
+
+    wrappers = {}
+    for callback, event in handlers:
+        if callback not in wrappers:
+            wrappers[callback] = _timed_handler(callback)
+
+        client.add_event_handler(wrappers[callback], event)
+
+
+def _profile(seconds: float, interval: float = 0.005) -> str:
+    """Samples the event loop's stack, in collapsed (flame graph) format."""
+    thread_id = threading.main_thread().ident
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({code.co_filename}:'
+                         f'{frame.f_lineno})')
+            frame = frame.f_back
+
+        stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return ''.join(f'{stack} {count}\n'
+                   for stack, count in stacks.most_common())
+
+
+async def _respond(reader: asyncio.StreamReader,
+                   writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # headers
+
+        target = urlsplit(request.split()[1].decode())
+        if target.path == '/metrics':
+            status, body = '200 OK', render()
+
+        elif target.path == '/profile' and config.METRICS_PROFILER:
+            seconds = float(parse_qs(target.query).get('seconds', ['10'])[0])
+            # Sampled from a thread, so the loop keeps running meanwhile.
+            status, body = '200 OK', await asyncio.to_thread(
+                _profile, min(seconds, 300))
+
+        else:
+            status, body = '404 Not Found', ''
+
+        body = body.encode()
+        writer.write(f'HTTP/1.0 {status}\r\n'
+                     'Content-Type: text/plain; version=0.0.4\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+    except (IndexError, ValueError, ConnectionError):
+        pass
+
+    finally:
+        writer.close()
+
+
+async def serve():
+    """Serves /metrics, and /profile?seconds=N when METRICS_PROFILER is set."""
+    if not config.METRICS_PORT:
+        return
+
+    server = await asyncio.start_server(_respond, config.METRICS_HOST,
+                                        config.METRICS_PORT)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,128 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import datetime
+import itertools
+import typing as t
+
+import peewee
+from redis.exceptions import RedisError, ResponseError
+
+import config
+from . import storage
+from .cache import cache
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 10
+GENERATION_KEY = 'notes-search:generation'
+PAGE_KEY = 'notes-search:{}:{}'
+# note ID -> timestamp of its last use, until stored; renamed while storing
+USED_KEY = 'notes-used'
+STORING_KEY = 'notes-used:storing'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _julian(stamp: float) -> float:
+    # As the database reads the naive local time it is going to be stored as.
+    local = datetime.datetime.fromtimestamp(stamp)
+    return (local - EPOCH).total_seconds() / 86400 + 2440587.5
+
+
+async def used(note_id: int):
+    """Records a use of a note, stored later on by `store_forever`."""
+    await cache.hset(USED_KEY, note_id, time.time())
+
+
+async def _unstored() -> t.Dict[int, float]:
+    async with cache.pipeline(transaction=False) as pipe:
+        pipe.hgetall(STORING_KEY)
+        pipe.hgetall(USED_KEY)
+        storing, fresh = await pipe.execute()
+
+    stamps = {}
+    for note_id, stamp in itertools.chain(storing.items(), fresh.items()):
+        stamps[int(note_id)] = max(float(stamp), stamps.get(int(note_id), 0))
+
+    return stamps
+
+
+async def search(query: str,
+                 offset: str) -> t.Tuple[t.List[t.Tuple[int, str]], str]:
+    """Returns one page of (id, message) notes and the next offset.
+
+    The offset is a keyset cursor, `now:rank:id`, so later pages never scan
+    the earlier ones and keep the ranking the first page was made with.
+    """
+    generation = await cache.get(GENERATION_KEY) or 0
+    key = PAGE_KEY.format(
+        generation,
+        hashlib.sha1(f'{query}\0{offset}'.encode()).hexdigest())
+    page = await cache.get(key)
+    if page:
+        return tuple(json.loads(page))
+
+    if offset:
+        now, rank, note_id = offset.split(':')
+        now, after = float(now), (float(rank), int(note_id))
+
+    else:
+        now, after = _julian(time.time()), (float('-inf'), 0)
+
+    used = {
+        note_id: _julian(stamp)
+        for note_id, stamp in (await _unstored()).items()
+    }
+    notes = await storage.run(storage.search_notes, re.findall(r'\w+', query),
+                              now, after, PAGE_SIZE, used)
+    result = [(note.id, note.message) for note in notes]
+    next_offset = ''
+    if len(notes) == PAGE_SIZE:
+        last = notes[-1]
+        next_offset = f'{float(now)!r}:{float(last.rank)!r}:{last.id}'
+
+    await cache.setex(key, config.NOTES_SEARCH_CACHE_TTL,
+                      json.dumps([result, next_offset]))
+    return result, next_offset
+
+
+async def invalidate():
+    """Drops every cached page; called whenever notes are added or removed."""
+    await cache.incr(GENERATION_KEY)
+
+
+async def store():
+    """Writes the uses recorded so far to the database, in one statement.
+
+    The hash is renamed first so uses recorded meanwhile are kept for the
+    next round, and a round cut short is picked up again by the next one.
+    """
+    try:
+        await cache.renamenx(USED_KEY, STORING_KEY)
+
+    except ResponseError:
+        pass  # nothing new was used
+
+    stamps = await cache.hgetall(STORING_KEY)
+    if stamps:
+        await storage.run(
+            storage.touch_notes, {
+                int(note_id): datetime.datetime.fromtimestamp(float(stamp))
+                for note_id, stamp in stamps.items()
+            })
+
+    await cache.delete(STORING_KEY)
+
+
+async def store_forever():
+    while True:
+        await asyncio.sleep(config.NOTES_USED_STORE_INTERVAL)
+        try:
+            await store()
+
+        except (RedisError, peewee.PeeweeException):
+            logger.exception('could not store the uses of notes')
@@ -0,0 +1,215 @@
+import zlib
+import base64
+import asyncio
+import logging
+import functools
+import typing as t
+
+from redis.exceptions import RedisError, ResponseError
+from telethon import TelegramClient, events, types, utils
+from telethon.extensions import BinaryReader
+
+import config
+from . import catchup
+from .cache import cache
+
+logger = logging.getLogger(__name__)
+
+STREAM = 'updates:{}'
+GROUP = 'workers'
+
+# The updates the registered handlers build their events from, anything
+# else would only fill the streams.
+CONSUMED = (
+    types.UpdateNewMessage,
+    types.UpdateNewChannelMessage,
+    types.UpdateShortMessage,
+    types.UpdateShortChatMessage,
+    types.UpdateEditMessage,
+    types.UpdateEditChannelMessage,
+    types.UpdateDeleteMessages,
+    types.UpdateDeleteChannelMessages,
+    types.UpdateBotInlineQuery,
+    types.UpdateBotCallbackQuery,
+    types.UpdateInlineBotCallbackQuery,
+    types.UpdateBotMessageReaction,
+    types.UpdateUser,
+    types.UpdateUserName,
+    types.UpdateChatParticipantAdd,
+    types.UpdateChatParticipantDelete,
+    types.UpdateChannelParticipant,
+    types.UpdatePinnedMessages,
+    types.UpdatePinnedChannelMessages,
+)
+
+
+def _partition(update) -> int:
+    """Hashes an update to the stream of the conversation it belongs to.
+
+    Entries of one stream are handled by one worker, in order, so this
+    has to agree with how the dispatcher orders the handlers.
+    """
+    message = getattr(update, 'message', None)
+    peer = getattr(message, 'peer_id', None) or getattr(update, 'peer', None)
+    if peer is not None:
+        key = utils.get_peer_id(peer)
+
+    else:
+        key = (getattr(update, 'channel_id', None)
+               or getattr(update, 'user_id', None) or 0)
+
+    reply_to = getattr(message, 'reply_to', None)
+    if isinstance(reply_to, types.MessageReplyHeader) and reply_to.forum_topic:
+        key = reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+
+    return zlib.crc32(str(key).encode()) % config.PIPELINE_PARTITIONS
+
+
+def encode(update) -> str:
+    # Wrapped in Updates so the entities the update came with travel along.
+    entities = getattr(update, '_entities', None) or {}
+    users = [e for e in entities.values() if isinstance(e, types.User)]
+    chats = [e for e in entities.values() if not isinstance(e, types.User)]
+    container = types.Updates([update], users, chats, date=None, seq=0)
+    return base64.b64encode(bytes(container)).decode()
+
+
+def decode(data: str) -> types.Updates:
+    with BinaryReader(base64.b64decode(data)) as reader:
+        return reader.tgread_object()
+
+
+async def _append(name: str, update):
+    fields = {'client': name, 'update': encode(update)}
+    stream = STREAM.format(_partition(update))
+    while True:
+        try:
+            await cache.xadd(stream,
+                             fields,
+                             maxlen=config.PIPELINE_STREAM_LENGTH,
+                             approximate=True)
+            return
+
+        except RedisError:
+            logger.warning('redis is unavailable, holding an update')
+            await asyncio.sleep(config.REDIS_TIMEOUT)
+
+
+def ingest(clients: t.Dict[str, TelegramClient]):
+    """Replaces every handler with one appending the updates they consume
+    to the streams.
+    """
+    for name, client in clients.items():
+        for callback, event in client.list_event_handlers():
+            client.remove_event_handler(callback, event)
+
+        client.add_event_handler(functools.partial(_append, name),
+                                 events.Raw(CONSUMED))
+
+
+async def _create_group(stream: str):
+    try:
+        await cache.xgroup_create(stream, GROUP, id='0', mkstream=True)
+
+    except ResponseError as error:
+        if 'BUSYGROUP' not in str(error):
+            raise
+
+
+async def _recover(stream: str, consumer: str):
+    """Takes over entries left pending by workers that went away."""
+    start = '0-0'
+    while True:
+        start, *_ = await cache.xautoclaim(
+            stream,
+            GROUP,
+            consumer,
+            min_idle_time=config.PIPELINE_CLAIM_IDLE * 1000,
+            start_id=start,
+            count=config.PIPELINE_INFLIGHT)
+        if start == '0-0':
+            return
+
+
+async def _handle(clients: t.Dict[str, TelegramClient], stream: str,
+                  entry_id: str, fields: dict):
+    try:
+        client = clients[fields['client']]  # fields is None if trimmed
+        container = decode(fields['update'])
+        for update in await client._preprocess_updates(
+                container.updates, container.users, container.chats):
+            # Same path as an update the client received itself.
+            await client._dispatch_update(update)
+
+    except Exception:
+        logger.exception('dropping unreadable update %s', entry_id)
+
+    try:
+        await cache.xack(stream, GROUP, entry_id)
+
+    except RedisError:
+        logger.warning('could not ack %s, it will be handled again', entry_id)
+
+
+async def _consume(clients: t.Dict[str, TelegramClient], partition: int,
+                   slots: asyncio.Semaphore):
+    stream = STREAM.format(partition)
+    consumer = f'worker-{config.PIPELINE_WORKER_ID}'
+    running: t.Dict[str, asyncio.Task] = {}
+    cursor = None
+    while True:
+        try:
+            if cursor is None:
+                await _create_group(stream)
+                await _recover(stream, consumer)
+                cursor = '0'  # our own pending entries first
+
+            while await catchup.held():
+                await asyncio.sleep(1)  # missed updates go first
+
+            await slots.acquire()
+            slots.release()
+            response = await cache.xreadgroup(
+                GROUP,
+                consumer, {stream: cursor},
+                count=config.PIPELINE_INFLIGHT,
+                block=None if cursor != '>' else config.PIPELINE_BLOCK * 1000)
+
+        except RedisError:
+            logger.warning('redis is unavailable, %s is paused', stream)
+            cursor = None
+            await asyncio.sleep(config.REDIS_TIMEOUT)
+            continue
+
+        entries = response[0][1] if response else []
+        if not entries:
+            # History drained, or idle: look for abandoned entries next time.
+            cursor = '>' if cursor != '>' else None
+            continue
+
+        for entry_id, fields in entries:
+            if cursor != '>':
+                cursor = entry_id
+
+            if entry_id in running:
+                continue  # read again from the history, still being handled
+
+            await slots.acquire()
+            task = running[entry_id] = asyncio.ensure_future(
+                _handle(clients, stream, entry_id, fields))
+            task.add_done_callback(
+                lambda _, entry_id=entry_id: (running.pop(entry_id, None),
+                                              slots.release()))
+
+
+async def work(clients: t.Dict[str, TelegramClient]):
+    """Handles the updates of this worker's share of the streams.
+
+    Each stream belongs to exactly one worker, so updates of the same
+    conversation keep their order even with several worker processes.
+    """
+    slots = asyncio.Semaphore(config.PIPELINE_INFLIGHT)
+    await asyncio.gather(*(
+        _consume(clients, partition, slots)
+        for partition in range(config.PIPELINE_PARTITIONS)
+        if partition % config.PIPELINE_WORKERS == config.PIPELINE_WORKER_ID))
@@ -0,0 +1,137 @@
+import json
+import typing as t
+
+from telethon import errors, types
+
+import config
+from .lru import LRU
+from .cache import cache
+
+CACHE_KEY = 'profile:{}'
+PHOTO_KEY = 'profile-photo:{}'
+
+# user_id -> rendered profile, and user_id -> the profile photo as the
+# bot sent it: [source photo ID, photo ID, access hash, file reference]
+_profiles = LRU(config.PROFILE_CACHE_SIZE)
+_photos = LRU(config.PROFILE_CACHE_SIZE)
+
+
+def render(entity: types.User) -> dict:
+    """Builds the topic title and the profile card shown to admins."""
+    title = entity.first_name
+    if entity.last_name:
+        title += ' ' + entity.last_name
+
+    if entity.username is not None:
+        title += f'(@{entity.username})'
+
+    card = (
+        f'• نام: {entity.first_name} {entity.last_name or ""}\n'
+        f'• شناسه: `{entity.id}`\n'
+        f'• نام کاربری: {"@" + entity.username if entity.username else "ندارد!"}'
+    )
+
+    if entity.fake:
+        card += '\n\n**⚠️ این کاربر مشکوک به جعل هویت است!**'
+
+    if entity.scam:
+        card += '\n\n**⚠️ این کاربر مشکوک به کلاهبرداری است!**'
+
+    photo_id = None
+    if isinstance(entity.photo, types.UserProfilePhoto):
+        photo_id = entity.photo.photo_id
+
+    return {'title': title, 'card': card, 'photo_id': photo_id}
+
+
+async def get(client, user_id: int,
+              entity: t.Optional[types.User] = None) -> dict:
+    """Returns the rendered profile of a user.
+
+    Passing the `entity` an update already carries refreshes the cache
+    for free; otherwise the entity is only fetched on a miss.
+    """
+    key = CACHE_KEY.format(user_id)
+    if entity is None:
+        profile = _profiles.get(user_id)
+        if profile is not None:
+            return profile
+
+        value = await cache.get(key)
+        if value:
+            profile = json.loads(value)
+            _profiles.put(user_id, profile)
+            return profile
+
+        entity = await client.get_entity(user_id)
+
+    profile = render(entity)
+    _profiles.put(user_id, profile)
+    await cache.setex(key, config.PROFILE_CACHE_TTL, json.dumps(profile))
+    return profile
+
+
+async def _sent_photo(user_id: int, photo_id: int):
+    value = _photos.get(user_id)
+    if value is None:
+        value = await cache.get(PHOTO_KEY.format(user_id))
+        if value is None:
+            return None
+
+        value = json.loads(value)
+        _photos.put(user_id, value)
+
+    if value[0] != photo_id:
+        return None
+
+    return types.InputPhoto(value[1], value[2], bytes.fromhex(value[3]))
+
+
+async def send_card(sender, source, user_id: int, profile: dict, **kwargs):
+    """Sends the profile card with the user's photo, uploading it only once.
+
+    `sender` keeps the photo it sent as a reusable reference; `source` is
+    the client able to download it when that reference is missing.
+    """
+    photo_id = profile['photo_id']
+    if photo_id is None:
+        return await sender.send_message(config.CHAT_ID, profile['card'],
+                                         **kwargs)
+
+    photo = await _sent_photo(user_id, photo_id)
+    if photo is not None:
+        try:
+            return await sender.send_file(config.CHAT_ID,
+                                          photo,
+                                          caption=profile['card'],
+                                          **kwargs)
+
+        except (errors.FileReferenceExpiredError, errors.MediaEmptyError):
+            pass
+
+    photo = await source.download_profile_photo(user_id, file=bytes)
+    if not photo:
+        return await sender.send_message(config.CHAT_ID, profile['card'],
+                                         **kwargs)
+
+    message = await sender.send_file(config.CHAT_ID,
+                                     photo,
+                                     caption=profile['card'],
+                                     **kwargs)
+    if isinstance(message.media, types.MessageMediaPhoto):
+        photo = message.media.photo
+        value = [
+            photo_id, photo.id, photo.access_hash,
+            photo.file_reference.hex()
+        ]
+        _photos.put(user_id, value)
+        await cache.setex(PHOTO_KEY.format(user_id), config.PROFILE_CACHE_TTL,
+                          json.dumps(value))
+
+    return message
+
+
+async def invalidate(user_id: int):
+    """Forgets the rendered profile; the sent photo is checked by its ID."""
+    _profiles.discard(user_id)
+    await cache.delete(CACHE_KEY.format(user_id))
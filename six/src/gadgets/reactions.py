@@ -0,0 +1,86 @@
+import json
+import typing as t
+
+from telethon import types, utils
+
+import config
+from .cache import cache
+
+ADMINS_KEY = 'reactions:{}'  # admin ID -> their reactions to a topic message
+
+CUSTOM = 'custom:'
+
+
+def _encode(reaction: types.TypeReaction) -> t.Optional[str]:
+    if isinstance(reaction, types.ReactionEmoji):
+        return reaction.emoticon
+
+    if isinstance(reaction, types.ReactionCustomEmoji):
+        return f'{CUSTOM}{reaction.document_id}'
+
+    return None  # paid reactions and the like can't be mirrored
+
+
+def _decode(value: str) -> types.TypeReaction:
+    if value.startswith(CUSTOM):
+        return types.ReactionCustomEmoji(int(value[len(CUSTOM):]))
+
+    return types.ReactionEmoji(value)
+
+
+def pack(reactions: t.Iterable[str]) -> str:
+    """Returns the text a set of reactions is mirrored and compared as."""
+    chosen = list(dict.fromkeys(reactions))[:config.REACTIONS_MAX]
+    return json.dumps(sorted(chosen), ensure_ascii=False)
+
+
+def unpack(value: str) -> t.List[types.TypeReaction]:
+    return [_decode(reaction) for reaction in json.loads(value)]
+
+
+def theirs(reactions: t.Optional[types.MessageReactions]) -> t.List[str]:
+    """Returns the reactions in a private chat that its peer chose.
+
+    Ours have a `chosen_order`; they are the ones mirrored from the topic.
+    """
+    chosen = []
+    for result in reactions.results if reactions else ():
+        count = result.count - (result.chosen_order is not None)
+        value = _encode(result.reaction)
+        if count > 0 and value is not None:
+            chosen.append(value)
+
+    return chosen
+
+
+async def admin_reacted(
+        update: types.UpdateBotMessageReaction) -> t.List[str]:
+    """Records what one admin reacts with now, returns what all of them do.
+
+    Telegram tells bots about each reactor separately, so the reactions
+    of every admin are kept per topic message to know what is left when
+    one of them takes theirs back.
+    """
+    key = ADMINS_KEY.format(update.msg_id)
+    actor = utils.get_peer_id(update.actor)
+    new = [
+        value for value in map(_encode, update.new_reactions)
+        if value is not None
+    ]
+    async with cache.pipeline(transaction=True) as pipe:
+        if new:
+            pipe.hset(key, actor, json.dumps(new, ensure_ascii=False))
+
+        else:
+            pipe.hdel(key, actor)
+
+        pipe.expire(key, config.REACTIONS_CACHE_TTL)
+        pipe.hvals(key)
+        *_, values = await pipe.execute()
+
+    # The latest reactor's first, for when only some can be mirrored.
+    chosen = dict.fromkeys(new)
+    for value in values:
+        chosen.update(dict.fromkeys(json.loads(value)))
+
+    return list(chosen)
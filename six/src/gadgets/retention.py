@@ -0,0 +1,87 @@
+import os
+import gzip
+import json
+import asyncio
+import logging
+import datetime
+import typing as t
+
+import peewee
+
+import config
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_NAME = 'messages-{:%Y-%m-%d}.jsonl.gz'
+
+
+def _append(path: str, lines: str):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # Appending adds a gzip member; readers see a single stream.
+    with gzip.open(path, 'at', encoding='utf-8') as archive:
+        archive.write(lines)
+
+
+async def _archive(messages: t.List[storage.Messages]):
+    """Moves mappings to today's archive file, then out of the table."""
+    lines = ''.join(
+        json.dumps({
+            'user_id': message.user.user_id,
+            'user_message_id': message.user_message_id,
+            'topic_message_id': message.topic_message_id,
+            'created_date': message.created_date.isoformat(),
+        }) + '\n' for message in messages)
+    path = os.path.join(config.ARCHIVE_PATH,
+                        ARCHIVE_NAME.format(datetime.date.today()))
+    await asyncio.to_thread(_append, path, lines)
+    await storage.delete_messages(messages)
+
+
+async def run() -> int:
+    """Archives the mappings past their age or per-user limit.
+
+    Works in batches of RETENTION_BATCH, so the updates being handled
+    meanwhile only ever wait for one of them. Returns how many went.
+    """
+    archived = 0
+    before = datetime.datetime.now() - datetime.timedelta(
+        seconds=config.RETENTION_MAX_AGE)
+    while True:
+        messages = await storage.run(storage.expired_messages, before,
+                                     config.RETENTION_BATCH)
+        if not messages:
+            break
+
+        await _archive(messages)
+        archived += len(messages)
+
+    for user_id in await storage.run(storage.crowded_users,
+                                     config.RETENTION_MAX_PER_USER):
+        while True:
+            messages = await storage.run(storage.excess_messages, user_id,
+                                         config.RETENTION_MAX_PER_USER,
+                                         config.RETENTION_BATCH)
+            if not messages:
+                break
+
+            await _archive(messages)
+            archived += len(messages)
+
+    if archived:
+        await storage.run(storage.compact)
+
+    return archived
+
+
+async def run_forever():
+    while True:
+        try:
+            archived = await run()
+            if archived:
+                logger.info('archived %d message mappings', archived)
+
+        except (OSError, peewee.PeeweeException):
+            logger.exception('could not archive message mappings')
+
+        await asyncio.sleep(config.RETENTION_INTERVAL)
@@ -0,0 +1,263 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import typing as t
+from enum import IntEnum
+
+from telethon import TelegramClient, errors, utils
+
+import config
+from . import metrics
+from .lru import LRU
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    RELAY = 0  # messages users and admins are waiting for
+    MODERATION = 1
+    MIRROR = 2  # edits and deletions of already relayed messages
+    REACTION = 3
+    BACKGROUND = 4
+    BROADCAST = 5  # only what everything else leaves over
+
+
+class _Bucket:
+    """Token bucket refilled at `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self) -> float:
+        """Returns how long until a token is available."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self) -> float:
+        """Takes a token, returning how long to wait to pay off any debt."""
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Outbound:
+    """Stands in for a client, sending every call through its scheduler."""
+
+    def __init__(self, scheduler: 'Scheduler', priority: Priority):
+        self._scheduler = scheduler
+        self._priority = priority
+
+    def __getattr__(self, name):
+        attribute = getattr(self._scheduler.client, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await self._scheduler.call(self._priority,
+                                              args[0] if args else None,
+                                              attribute, *args, **kwargs)
+
+        return call
+
+    async def __call__(self, request):
+        peer = (getattr(request, 'peer', None)
+                or getattr(request, 'channel', None))
+        return await self._scheduler.call(self._priority, peer,
+                                          self._scheduler.client, request)
+
+
+class Scheduler:
+    """Shares one client's rate budget between callers by priority.
+
+    Every call takes a token from the client's bucket and one from the
+    bucket of the peer it targets, both at the moment it is granted: the
+    most urgent call whose peer has a token goes first, so a relay never
+    waits behind the reactions queued for the same chat. A FloodWait
+    pauses the method it hit for the time Telegram asked, after which the
+    call is retried; so are transient server errors, with jittered backoff.
+    """
+
+    def __init__(self, client: TelegramClient, rate: t.Tuple[float, float],
+                 peer_rate: t.Tuple[float, float], name: str = ''):
+        self.client = client
+        self.name = name  # of the client, for metrics
+        self.peer_rate = peer_rate
+        self._bucket = _Bucket(*rate)
+        self._peers = LRU(config.RPC_PEER_BUCKETS)
+        # peer ID (None for calls without one) -> its waiting calls as a
+        # heap of (priority, sequence, future, method)
+        self._queues: t.Dict[t.Optional[int], list] = {}
+        # (priority, sequence, peer ID) of the first call of every queue;
+        # entries whose call is not the first anymore are skipped
+        self._heads = []
+        self._sequence = itertools.count()
+        self._granter: t.Optional[asyncio.Future] = None
+        # method -> when the FloodWait it got is over
+        self._blocked: t.Dict[str, float] = {}
+        self._arrived = asyncio.Event()  # wakes the granter up for new calls
+
+        self.relay = Outbound(self, Priority.RELAY)
+        self.moderation = Outbound(self, Priority.MODERATION)
+        self.mirror = Outbound(self, Priority.MIRROR)
+        self.reaction = Outbound(self, Priority.REACTION)
+        self.background = Outbound(self, Priority.BACKGROUND)
+        self.broadcast = Outbound(self, Priority.BROADCAST)
+
+    def _peer_bucket(self, peer_id: int) -> _Bucket:
+        bucket = self._peers.get(peer_id)
+        if bucket is None:
+            # The group carries every topic, so a chat's budget won't do.
+            rate = (config.RPC_CHAT_RATE
+                    if peer_id == config.CHAT_ID else self.peer_rate)
+            bucket = _Bucket(*rate)
+            self._peers.put(peer_id, bucket)
+
+        return bucket
+
+    def _first(self, peer_id: t.Optional[int]) -> t.Optional[tuple]:
+        """Returns the first live call waiting for a peer, if any."""
+        queue = self._queues.get(peer_id)
+        while queue and queue[0][2].cancelled():
+            heapq.heappop(queue)
+
+        if not queue:
+            self._queues.pop(peer_id, None)
+            return None
+
+        return queue[0]
+
+    def _next(self) -> t.Tuple[t.Optional[tuple], float]:
+        """Pops the head of the most urgent call that can go right away.
+
+        Returns None instead if every call waits for its peer's token or
+        a FloodWait, with how long until the first of them can go.
+        """
+        parked = []
+        chosen, delay = None, float('inf')
+        while self._heads:
+            head = heapq.heappop(self._heads)
+            priority, sequence, peer_id = head
+            first = self._first(peer_id)
+            if first is None or first[:2] != (priority, sequence):
+                if first is not None:
+                    heapq.heappush(self._heads, (*first[:2], peer_id))
+
+                continue
+
+            wait = max(
+                self._blocked.get(first[3], 0.0) - time.monotonic(),
+                self._peer_bucket(peer_id).wait()
+                if peer_id is not None else 0.0)
+            if wait <= 0:
+                chosen = head
+                break
+
+            parked.append(head)
+            delay = min(delay, wait)
+
+        for head in parked:
+            heapq.heappush(self._heads, head)
+
+        return chosen, delay
+
+    async def _grant(self):
+        while self._heads:
+            delay = self._bucket.wait()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            head, delay = self._next()
+            if head is None:
+                if self._heads:
+                    # A call that arrives meanwhile may be able to go now.
+                    self._arrived.clear()
+                    try:
+                        await asyncio.wait_for(self._arrived.wait(), delay)
+
+                    except asyncio.TimeoutError:
+                        pass
+
+                continue
+
+            peer_id = head[2]
+            self._bucket.take()
+            if peer_id is not None:
+                self._peer_bucket(peer_id).take()
+
+            queue = self._queues[peer_id]
+            heapq.heappop(queue)[2].set_result(None)
+            first = self._first(peer_id)
+            if first is not None:
+                heapq.heappush(self._heads, (*first[:2], peer_id))
+
+    async def _acquire(self, priority: Priority, peer, method: str):
+        try:
+            peer_id = utils.get_peer_id(peer) if peer is not None else None
+
+        except TypeError:
+            peer_id = None
+
+        future = asyncio.get_running_loop().create_future()
+        entry = priority, next(self._sequence), future, method
+        queue = self._queues.setdefault(peer_id, [])
+        heapq.heappush(queue, entry)
+        if queue[0] is entry:
+            heapq.heappush(self._heads, (*entry[:2], peer_id))
+
+        self._arrived.set()
+
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.ensure_future(self._grant())
+
+        await future
+
+    async def _timed(self, method: str, func, *args, **kwargs):
+        try:
+            with metrics.rpc_seconds.time(self.name, method):
+                return await func(*args, **kwargs)
+
+        except Exception as error:
+            metrics.rpc_errors.inc(self.name, method, type(error).__name__)
+            raise
+
+    async def call(self, priority: Priority, peer, func, *args, **kwargs):
+        """Awaits `func(*args, **kwargs)` within the rate budget."""
+        if func is self.client:
+            method = type(args[0]).__name__
+
+        else:
+            method = getattr(func, '__name__', 'call')
+
+        for attempt in range(config.RPC_RETRIES):
+            await self._acquire(priority, peer, method)
+            try:
+                return await self._timed(method, func, *args, **kwargs)
+
+            except errors.FloodWaitError as error:
+                logger.warning('FloodWait of %ds on %s', error.seconds, method)
+                metrics.flood_wait_seconds.inc(self.name, amount=error.seconds)
+                delay = error.seconds + random.uniform(0, 1)
+                self._blocked[method] = max(self._blocked.get(method, 0.0),
+                                            time.monotonic() + delay)
+                if attempt == config.RPC_RETRIES - 1:
+                    raise
+
+            except (errors.ServerError, errors.RpcCallFailError,
+                    ConnectionError, asyncio.TimeoutError):
+                if attempt == config.RPC_RETRIES - 1:
+                    raise
+
+                await asyncio.sleep(random.uniform(0, 2**attempt))
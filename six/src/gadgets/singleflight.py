@@ -0,0 +1,49 @@
+import asyncio
+import typing as t
+
+import config
+from .cache import cache
+
+LOCK_KEY = 'single-flight:{}'
+
+_flights: t.Dict[str, asyncio.Future] = {}
+
+
+async def run(key: str, func: t.Callable[[], t.Awaitable]):
+    """Runs `func` once for every concurrent caller using the same key.
+
+    Callers in this process share one in-flight call; other processes
+    are kept out by a Redis lock, so `func` should re-check whatever it
+    is about to create before creating it.
+    """
+    flight = _flights.get(key)
+    if flight is not None:
+        try:
+            return await asyncio.shield(flight)
+
+        except asyncio.CancelledError:
+            if not flight.cancelled():
+                raise
+
+            return await run(key, func)  # its caller was cancelled, not us
+
+    flight = _flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        async with cache.lock(LOCK_KEY.format(key),
+                              timeout=config.SINGLE_FLIGHT_TIMEOUT,
+                              blocking_timeout=config.SINGLE_FLIGHT_TIMEOUT):
+            result = await func()
+
+    except Exception as error:
+        flight.set_exception(error)
+        flight.exception()  # retrieved here, even when nobody else waits
+        raise
+
+    else:
+        flight.set_result(result)
+        return result
+
+    finally:
+        del _flights[key]
+        if not flight.done():
+            flight.cancel()  # cancelled itself; the others take over
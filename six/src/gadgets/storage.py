@@ -1,52 +1,463 @@
-import time
-import os
-import config
-import peewee
-from datetime import datetime
-
-# Create directory for SQLite database
-os.makedirs('.app-data/sqlite', exist_ok=True)
-
-# Use SQLite database instead of MySQL
-database = peewee.SqliteDatabase('.app-data/sqlite/support-bot.db')
-
-class BaseModel(peewee.Model):
-    class Meta:
-        database = database
-
-class Users(BaseModel):
-    id = peewee.AutoField()
-    user_id = peewee.BigIntegerField(index=True)
-    topic_id = peewee.IntegerField(index=True, null=True)
-    registration_date = peewee.DateTimeField(default=datetime.now)
-
-
-class Notes(BaseModel):
-    id = peewee.AutoField()
-    user_id = peewee.BigIntegerField(index=True)
-    message = peewee.TextField()
-    last_used_date = peewee.DateTimeField(default=datetime.now)
-
-
-class Messages(BaseModel):
-    id = peewee.AutoField()
-    user = peewee.ForeignKeyField(Users,
-                                  backref='messages',
-                                  on_delete='CASCADE')
-    user_message_id = peewee.IntegerField(index=True)
-    topic_message_id = peewee.IntegerField(index=True)
-
-
-for _ in range(10):
-    try:
-        database.connect()
-
-    except BaseException:
-        time.sleep(1)
-
-    else:
-        database.create_tables([Users, Notes, Messages])
-        break
-
-else:
-    exit('Unable to connect to SQLite database')
+import time
+import os
+import asyncio
+import functools
+import itertools
+import config
+import peewee
+import typing as t
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from playhouse.db_url import parse
+from playhouse.pool import PooledSqliteDatabase, PooledPostgresqlDatabase
+
+from . import metrics
+from .lru import LRU
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16 * 1024,
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,
+    'foreign_keys': 1,
+}
+
+
+class _Timed:
+    """Times every statement in `metrics`, by its first keyword."""
+
+    def execute_sql(self, sql, *args, **kwargs):
+        with metrics.db_query_seconds.time(sql.split(None, 1)[0].upper()):
+            return super().execute_sql(sql, *args, **kwargs)
+
+
+class _SqliteDatabase(_Timed, PooledSqliteDatabase):
+    pass
+
+
+class _PostgresqlDatabase(_Timed, PooledPostgresqlDatabase):
+    pass
+
+
+def create_database(kind: str, path: str) -> peewee.Database:
+    """Returns a pooled database of the given `DATABASE_TYPE`.
+
+    `path` is the database file for SQLite and a postgresql:// URL for
+    PostgreSQL.
+    """
+    if kind == 'sqlite':
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return _SqliteDatabase(
+            path,
+            pragmas=SQLITE_PRAGMAS,
+            check_same_thread=False,  # the pool hands them between threads
+            max_connections=config.DATABASE_POOL_SIZE,
+            stale_timeout=config.DATABASE_STALE_TIMEOUT)
+
+    if kind in ('postgres', 'postgresql'):
+        return _PostgresqlDatabase(
+            max_connections=config.DATABASE_POOL_SIZE,
+            stale_timeout=config.DATABASE_STALE_TIMEOUT,
+            **parse(path))
+
+    raise ValueError(f'unsupported DATABASE_TYPE: {kind}')
+
+
+# Bound to the configured backend by `init`.
+database = peewee.DatabaseProxy()
+
+# Queries made from the event loop run on these threads, so the database
+# never blocks update processing. SQLite gets a single one so writers
+# never contend; PostgreSQL gets one per pooled connection.
+executor = ThreadPoolExecutor(
+    max_workers=1 if config.DATABASE_TYPE == 'sqlite' else
+    config.DATABASE_POOL_SIZE,
+    thread_name_prefix='storage')
+
+
+async def run(func, *args, **kwargs):
+    """Runs a blocking peewee call on the database thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs))
+
+
+async def atomic(func, *args, **kwargs):
+    """Like `run`, but wraps the call in a single short transaction."""
+
+    def transaction():
+        with database.atomic():
+            return func(*args, **kwargs)
+
+    return await run(transaction)
+
+
+class BaseModel(peewee.Model):
+    class Meta:
+        database = database
+
+class Users(BaseModel):
+    id = peewee.AutoField()
+    user_id = peewee.BigIntegerField(index=True)
+    topic_id = peewee.IntegerField(index=True, null=True)
+    registration_date = peewee.DateTimeField(default=datetime.now)
+
+
+class Notes(BaseModel):
+    id = peewee.AutoField()
+    user_id = peewee.BigIntegerField(index=True)
+    message = peewee.TextField()
+    last_used_date = peewee.DateTimeField(default=datetime.now)
+
+
+class Messages(BaseModel):
+    id = peewee.AutoField()
+    user = peewee.ForeignKeyField(Users,
+                                  backref='messages',
+                                  on_delete='CASCADE')
+    user_message_id = peewee.IntegerField(index=True)
+    topic_message_id = peewee.IntegerField(unique=True)
+    created_date = peewee.DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        indexes = ((('user', 'user_message_id'), True), )
+
+
+# Recently used mappings, keyed by the Telegram user ID so lookups never
+# need the Users row: (user_id, user_message_id) and topic_message_id.
+_by_user_message = LRU(config.MESSAGE_CACHE_SIZE)
+_by_topic_message = LRU(config.MESSAGE_CACHE_SIZE)
+
+
+def _remember(message: Messages):
+    _by_user_message.put((message.user.user_id, message.user_message_id),
+                         message)
+    _by_topic_message.put(message.topic_message_id, message)
+
+
+def _forget(message: Messages):
+    _by_user_message.discard((message.user.user_id, message.user_message_id))
+    _by_topic_message.discard(message.topic_message_id)
+
+
+def _select_messages():
+    return Messages.select(Messages, Users).join(Users)
+
+
+async def get_message_by_user(user_id: int, user_message_id: int):
+    """Returns the mapping of a message in the private chat with `user_id`."""
+    message = _by_user_message.get((user_id, user_message_id))
+    if message is None:
+        message = await run(
+            _select_messages().where(
+                Users.user_id == user_id,
+                Messages.user_message_id == user_message_id).get_or_none)
+        if message:
+            _remember(message)
+
+    return message
+
+
+async def get_message_by_topic(topic_message_id: int,
+                               user_id: t.Optional[int] = None):
+    """Returns the mapping of a topic message, optionally scoped by user."""
+    message = _by_topic_message.get(topic_message_id)
+    if message is None:
+        message = await run(
+            _select_messages().where(
+                Messages.topic_message_id == topic_message_id).get_or_none)
+        if message:
+            _remember(message)
+
+    if message and user_id is not None and message.user.user_id != user_id:
+        return None
+
+    return message
+
+
+async def find_messages(user_message_ids: t.List[int]):
+    """Returns the mappings of private messages whose chat is unknown.
+
+    Private message IDs are allocated per account, so `app` never reuses
+    one across chats; deletion updates are the only place lacking a chat.
+    """
+    return await run(
+        list,
+        _select_messages().where(
+            Messages.user_message_id.in_(user_message_ids)))
+
+
+async def create_message(user: Users, user_message_id: int,
+                         topic_message_id: int):
+    message = await run(Messages.create,
+                        user=user,
+                        user_message_id=user_message_id,
+                        topic_message_id=topic_message_id)
+    _remember(message)
+    return message
+
+
+async def create_messages(user: Users, pairs: t.List[t.Tuple[int, int]]):
+    """Stores (user_message_id, topic_message_id) mappings in bulk."""
+    rows = [{
+        'user': user.id,
+        'user_message_id': user_message_id,
+        'topic_message_id': topic_message_id
+    } for user_message_id, topic_message_id in pairs]
+
+    def insert():
+        created = []
+        for batch in peewee.chunked(rows, 500):
+            Messages.insert_many(batch).on_conflict_ignore().execute()
+            # Read back, as the rows that were there already win.
+            created.extend(_select_messages().where(
+                Messages.user == user,
+                Messages.user_message_id.in_(
+                    [row['user_message_id'] for row in batch])))
+
+        return created
+
+    if rows:
+        for message in await atomic(insert):
+            _remember(message)
+
+
+async def find_topic_messages(topic_message_ids: t.List[int]):
+    return await run(
+        list,
+        _select_messages().where(
+            Messages.topic_message_id.in_(topic_message_ids)))
+
+
+async def delete_messages(messages: t.List[Messages]):
+    """Deletes the given mappings with a single statement."""
+    for message in messages:
+        _forget(message)
+
+    if messages:
+        await run(
+            Messages.delete().where(
+                Messages.id.in_([message.id for message in messages])).execute)
+
+
+NOTES_FTS = (
+    'CREATE VIRTUAL TABLE notes_fts USING fts5('
+    "message, content='notes', content_rowid='id')",
+    'CREATE TRIGGER notes_fts_insert AFTER INSERT ON notes BEGIN '
+    'INSERT INTO notes_fts (rowid, message) VALUES (new.id, new.message); '
+    'END',
+    'CREATE TRIGGER notes_fts_delete AFTER DELETE ON notes BEGIN '
+    "INSERT INTO notes_fts (notes_fts, rowid, message) "
+    "VALUES ('delete', old.id, old.message); "
+    'END',
+    'CREATE TRIGGER notes_fts_update AFTER UPDATE OF message ON notes BEGIN '
+    "INSERT INTO notes_fts (notes_fts, rowid, message) "
+    "VALUES ('delete', old.id, old.message); "
+    'INSERT INTO notes_fts (rowid, message) VALUES (new.id, new.message); '
+    'END',
+    "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+)
+
+# Notes rank by text relevance (bm25, lower is better) minus a recency
+# bonus in (0, 1] that decays with the days since the note was last used.
+# `used` holds the uses not stored yet, as (note ID, julian day) rows.
+NOTES_SEARCH = (
+    'WITH used (id, day) AS ({used}) '
+    'SELECT * FROM ('
+    'SELECT notes.*, {relevance} - 1.0 / (1 + max(0, ? - coalesce('
+    'used.day, julianday(notes.last_used_date)))) AS rank '
+    'FROM {source} LEFT JOIN used ON used.id = notes.id {where}'
+    ') AS ranked WHERE rank > ? OR (rank = ? AND id > ?) '
+    'ORDER BY rank, id LIMIT ?')
+
+# PostgreSQL has no FTS5: every word must be a substring of the note, and
+# notes rank by recency alone. Parameters are floats, which psycopg2 inlines
+# as numeric literals, so the rank is cast back to come out as a float too.
+NOTES_SEARCH_ILIKE = (
+    'WITH used (id, day) AS ({used}) '
+    'SELECT * FROM ('
+    'SELECT notes.*, CAST(0 - 1.0 / (1 + greatest(0, %s - coalesce(used.day, '
+    'extract(epoch FROM notes.last_used_date) / 86400 + 2440587.5))) '
+    'AS float8) AS rank '
+    'FROM notes LEFT JOIN used ON used.id = notes.id WHERE {where}'
+    ') AS ranked WHERE rank > CAST(%s AS float8) '
+    'OR (rank = CAST(%s AS float8) AND id > %s) '
+    'ORDER BY rank, id LIMIT %s')
+
+
+def create_notes_index():
+    """Creates the FTS5 shadow index of Notes, kept in sync by triggers."""
+    if 'notes_fts' not in database.get_tables():
+        with database.atomic():
+            for statement in NOTES_FTS:
+                database.execute_sql(statement)
+
+
+def search_notes(words: t.List[str], now: float, after: t.Tuple[float, int],
+                 limit: int,
+                 used: t.Optional[t.Dict[int, float]] = None) -> t.List[Notes]:
+    """Returns the notes ranked right after the `after` (rank, id) key.
+
+    Notes match when they contain every word as a prefix (a substring on
+    PostgreSQL); no words lists every note by recency alone. `now` is a
+    julian day, fixed for all the pages of one search, and `used` maps
+    note IDs to the julian day of uses that are still to be stored.
+    """
+    used = list(itertools.chain.from_iterable((used or {}).items()))
+    if isinstance(database.obj, peewee.PostgresqlDatabase):
+        patterns = ['%' + word.replace('_', '\\_') + '%' for word in words]
+        query = NOTES_SEARCH_ILIKE.format(
+            used=' UNION ALL '.join(['SELECT %s, %s'] * (len(used) // 2))
+            or 'SELECT 0, 0.0 WHERE FALSE',
+            where=' AND '.join(['message ILIKE %s'] * len(words)) or 'TRUE')
+        params = [*used, now, *patterns]
+
+    else:
+        used_rows = (' UNION ALL '.join(['SELECT ?, ?'] * (len(used) // 2))
+                     or 'SELECT 0, 0.0 WHERE FALSE')
+        if not words:
+            query = NOTES_SEARCH.format(used=used_rows,
+                                        relevance='0',
+                                        source='notes',
+                                        where='')
+            params = [*used, now]
+
+        else:
+            query = NOTES_SEARCH.format(
+                used=used_rows,
+                relevance='bm25(notes_fts)',
+                source='notes_fts JOIN notes ON notes.id = notes_fts.rowid',
+                where='WHERE notes_fts MATCH ?')
+            params = [*used, now, ' '.join(f'"{word}"*' for word in words)]
+
+    return list(Notes.raw(query, *params, after[0], after[0], after[1], limit))
+
+
+def touch_notes(used: t.Dict[int, datetime]) -> int:
+    """Stores when notes were last used, all in one UPDATE."""
+    if not used:
+        return 0
+
+    return Notes.update(last_used_date=peewee.Case(
+        Notes.id, list(used.items()))).where(Notes.id.in_(list(used))).execute()
+
+
+async def purge_messages(user: Users):
+    """Deletes every mapping of a user, a batch at a time."""
+    for message in [
+            message for message in (*_by_user_message.values(),
+                                    *_by_topic_message.values())
+            if message.user.user_id == user.user_id
+    ]:
+        _forget(message)
+
+    batch = Messages.select(Messages.id).where(Messages.user == user).limit(
+        config.RETENTION_BATCH)
+    while await run(Messages.delete().where(Messages.id.in_(batch)).execute):
+        pass
+
+
+def users_after(last_id: int, limit: int) -> t.List[Users]:
+    """Returns the Users rows following the one with ID `last_id`."""
+    return list(
+        Users.select(Users.id, Users.user_id).where(
+            Users.id > last_id).order_by(Users.id).limit(limit))
+
+
+def expired_messages(before: datetime, limit: int) -> t.List[Messages]:
+    """Returns the oldest mappings created before `before`."""
+    return list(_select_messages().where(
+        Messages.created_date < before).order_by(Messages.id).limit(limit))
+
+
+def crowded_users(keep: int) -> t.List[int]:
+    """Returns the IDs of the Users rows with more than `keep` mappings."""
+    return [
+        row.user_id for row in Messages.select(Messages.user).group_by(
+            Messages.user).having(peewee.fn.COUNT(Messages.id) > keep)
+    ]
+
+
+def excess_messages(user_id: int, keep: int, limit: int) -> t.List[Messages]:
+    """Returns the oldest mappings of a Users row beyond its newest `keep`."""
+    newest = Messages.select(Messages.id).where(
+        Messages.user == user_id).order_by(Messages.id.desc()).limit(keep)
+    return list(_select_messages().where(
+        Messages.user == user_id,
+        Messages.id.not_in(newest)).order_by(Messages.id).limit(limit))
+
+
+def compact():
+    """Hands the pages freed by deletions back and refreshes statistics."""
+    if isinstance(database.obj, peewee.SqliteDatabase):
+        database.execute_sql('PRAGMA incremental_vacuum')
+
+    database.execute_sql('ANALYZE messages')
+
+
+def migrate():
+    """Upgrades the schema of a database created by older versions."""
+    if isinstance(database.obj, peewee.SqliteDatabase) and database.pragma(
+            'auto_vacuum') != 2:
+        # Only takes effect on an empty database, or through a VACUUM.
+        database.pragma('auto_vacuum', 'incremental')
+        database.execute_sql('VACUUM')
+
+    columns = {column.name for column in database.get_columns('messages')}
+    if columns and 'created_date' not in columns:
+        # A constant default makes it a metadata-only change, and rows of
+        # unknown age count from now on.
+        kind = ('TIMESTAMP' if isinstance(database.obj,
+                                          peewee.PostgresqlDatabase) else
+                'DATETIME')
+        with database.atomic():
+            database.execute_sql(
+                f'ALTER TABLE messages ADD COLUMN created_date {kind} '
+                f"NOT NULL DEFAULT '{datetime.now().isoformat(' ')}'")
+            database.execute_sql('CREATE INDEX messages_created_date '
+                                 'ON messages (created_date)')
+
+    indexes = {index.name: index for index in database.get_indexes('messages')}
+    if not indexes or 'messages_user_id_user_message_id' in indexes:
+        return
+
+    with database.atomic():
+        # Keep the newest mapping of any key that got duplicated.
+        for fields in ((Messages.user, Messages.user_message_id),
+                       (Messages.topic_message_id, )):
+            newest = Messages.select(peewee.fn.MAX(
+                Messages.id)).group_by(*fields)
+            Messages.delete().where(Messages.id.not_in(newest)).execute()
+
+        topic_index = indexes.get('messages_topic_message_id')
+        if topic_index and not topic_index.unique:
+            database.execute_sql('DROP INDEX messages_topic_message_id')
+
+
+def init():
+    """Connects to the configured database and brings its schema up to date."""
+    database.initialize(
+        create_database(config.DATABASE_TYPE, config.DATABASE_PATH))
+    for _ in range(10):
+        try:
+            database.connect()
+
+        except peewee.OperationalError:
+            time.sleep(1)
+
+        else:
+            break
+
+    else:
+        exit(f'Unable to connect to the {config.DATABASE_TYPE} database')
+
+    try:
+        migrate()
+        database.create_tables([Users, Notes, Messages])
+        if isinstance(database.obj, peewee.SqliteDatabase):
+            create_notes_index()
+
+    finally:
+        database.close()  # back to the pool; queries run on `executor`
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import typing as t
+
+from telethon import TelegramClient, errors, functions, types
+
+import config
+from . import storage
+from .cache import cache, announce, on_invalidate
+from .enums import TopicState
+
+logger = logging.getLogger(__name__)
+
+STATES_KEY = f'topic_state:{config.CHAT_ID}'
+STATE_KEY = STATES_KEY + ':{}'  # announced when a topic's state changes
+BATCH_SIZE = 100
+
+# topic_id -> TopicState, kept current by the forum service messages, here
+# or (announced on the invalidation channel) in the other processes
+_states: t.Dict[int, TopicState] = {}
+
+
+@on_invalidate
+def _invalidated(key: t.Optional[str]):
+    if key is None:
+        _states.clear()
+
+    elif key.startswith(STATE_KEY.format('')):
+        _states.pop(int(key[len(STATE_KEY.format('')):]), None)
+
+
+async def _store(states: t.Dict[int, TopicState]):
+    _states.update(states)
+    async with cache.pipeline(transaction=False) as pipe:
+        pipe.hset(STATES_KEY,
+                  mapping={
+                      str(topic_id): state.value
+                      for topic_id, state in states.items()
+                  })
+        for topic_id in states:
+            announce(pipe, STATE_KEY.format(topic_id))
+
+        await pipe.execute()
+
+
+async def set_state(topic_id: int, state: TopicState):
+    await _store({topic_id: state})
+
+
+async def fetch(client: TelegramClient, topic_ids: t.List[int]):
+    """Asks Telegram for the state of the given topics and caches it."""
+    result: types.messages.ForumTopics = await client(
+        functions.messages.GetForumTopicsByIDRequest(config.CHAT_ID,
+                                                     topics=topic_ids))
+    states = dict.fromkeys(topic_ids, TopicState.DELETED)
+    for topic in result.topics:
+        if isinstance(topic, types.ForumTopic):
+            states[topic.id] = (TopicState.CLOSED
+                                if topic.closed else TopicState.OPEN)
+
+    await _store(states)
+    return states
+
+
+async def get_state(client: TelegramClient, topic_id: int) -> TopicState:
+    """Returns the cached topic state, looking it up only on a miss."""
+    state = _states.get(topic_id)
+    if state is None:
+        value = await cache.hget(STATES_KEY, str(topic_id))
+        if value:
+            state = _states[topic_id] = TopicState(value)
+
+        else:
+            state = (await fetch(client, [topic_id]))[topic_id]
+
+    return state
+
+
+async def service_message(event):
+    """Applies a topic create/edit service message in CHAT_ID."""
+    action = event.message.action
+    if isinstance(action, types.MessageActionTopicCreate):
+        await set_state(event.message.id, TopicState.OPEN)
+
+    elif action.closed is not None:
+        reply_to = event.message.reply_to
+        await set_state(reply_to.reply_to_top_id or reply_to.reply_to_msg_id,
+                        TopicState.CLOSED if action.closed else TopicState.OPEN)
+
+
+async def messages_deleted(message_ids: t.List[int]):
+    """Marks the topics whose top message got deleted."""
+    users = await storage.run(
+        list,
+        storage.Users.select(storage.Users.topic_id).where(
+            storage.Users.topic_id.in_(message_ids)))
+    for user in users:
+        await set_state(user.topic_id, TopicState.DELETED)
+
+
+async def reconcile_forever(client: TelegramClient):
+    """Slowly re-reads every known topic to catch missed service messages."""
+    while client.is_connected():
+        await asyncio.sleep(config.TOPIC_RECONCILE_INTERVAL)
+
+        last_id = 0
+        while True:
+            users = await storage.run(
+                list,
+                storage.Users.select(storage.Users.id,
+                                     storage.Users.topic_id).where(
+                                         storage.Users.id > last_id,
+                                         storage.Users.topic_id.is_null(False)).
+                order_by(storage.Users.id).limit(BATCH_SIZE))
+            if not users:
+                break
+
+            last_id = users[-1].id
+            try:
+                await fetch(client, [user.topic_id for user in users])
+
+            except errors.RPCError:
+                logger.exception('unable to reconcile topic states')
+                break
@@ -1,527 +1,1046 @@
-import os
-import logging
-import datetime
-import typing as t
-
-import peewee
-from telethon import TelegramClient, Button, errors, types, functions, events
-
-import config
-from gadgets import storage, enums
-from gadgets.cache import cache, get_user_status, set_user_status
-
-logging.basicConfig(level=logging.WARNING)
-if not os.path.exists('.telegram-session'):
-    os.makedirs('.telegram-session')
-
-bot = TelegramClient('.telegram-session/bot',
-                     api_id=config.API_ID,
-                     api_hash=config.API_HASH)
-
-app = TelegramClient('.telegram-session/app',
-                     api_id=config.API_ID,
-                     api_hash=config.API_HASH)
-
-if config.ANONYMOUS_MODE:
-    helper = TelegramClient('.telegram-session/helper',
-                            api_id=config.API_ID,
-                            api_hash=config.API_HASH)
-
-else:
-    helper = app
-
-
-async def copy(sender: TelegramClient, event, target: int,
-               reply_to: t.Optional[int]):
-    file = None
-    if isinstance(event.media,
-                  (types.MessageMediaPhoto, types.MessageMediaDocument)):
-        if event.message.file.size <= config.LIMIT_FILE_DOWNLOAD:
-            file = await (bot if sender is app else app).download_media(
-                event.message)
-
-    return await sender.send_message(target,
-                                     event.message.message,
-                                     file=file,
-                                     reply_to=reply_to)
-
-
-@bot.on(events.NewMessage)
-@bot.on(events.InlineQuery)
-@bot.on(events.CallbackQuery)
-async def private_messages(event):
-    if event.sender_id in {802959264}:
-        event.is_admin = True
-    
-    else:
-        try:
-            await bot(
-                functions.channels.GetParticipantRequest(
-                    config.CHAT_ID, participant=event.sender_id))
-        except errors.RPCError:
-            event.is_admin = False
-
-        else:
-            event.is_admin = True
-
-    if event.is_private:
-        if not event.is_admin:
-            raise events.StopPropagation
-
-        event.status = await get_user_status(event.sender_id)
-
-
-@bot.on(events.NewMessage(chats=config.CHAT_ID))
-@bot.on(events.MessageEdited(chats=config.CHAT_ID))
-async def handle_group_message(event):
-    """Handles new, edited, and deleted messages in the chat."""
-    reply_to = event.message.reply_to
-    if reply_to is None or not reply_to.forum_topic:
-        raise events.StopPropagation
-
-    try:
-        event.user = storage.Users.get(
-            topic_id=reply_to.reply_to_top_id or reply_to.reply_to_msg_id)
-
-    except peewee.DoesNotExist:
-        await event.reply('این تاپیک نامعتبر است، لطفاً تاپیک را ببندید.')
-        raise events.StopPropagation
-
-
-@bot.on(events.InlineQuery(func=lambda e: e.is_admin))
-async def show_notes_handler(event):
-    offset = int(
-        event.original_update.offset) if event.original_update.offset else 0
-    querys = (storage.Notes.select().where(
-        storage.Notes.message.contains(event.original_update.query)).order_by(
-            storage.Notes.last_used_date.desc()).limit(10).offset(offset))
-
-    result = []
-    for note in querys:
-        result.append(
-            event.builder.article(note.message[:50],
-                                  description=note.message,
-                                  text=f'/note-{note.id}'))
-
-    if result:
-        await event.answer(result, cache_time=0, next_offset=str(offset + 10))
-
-
-@bot.on(events.NewMessage(pattern=r'^/note-(\d+)', func=lambda e: e.is_admin))
-async def handle_note_message(event):
-    if event.via_bot_id:
-        note_id = int(event.pattern_match.group(1))
-        note = storage.Notes.get_or_none(id=note_id)
-        if note:
-            if event.is_private:
-                await event.reply(note.message,
-                                  buttons=Button.inline(
-                                      '🗑 حذف', data=f'delete-note:{note_id}'))
-
-            else:
-                event.raw_text = note.message
-                note.last_used_date = datetime.datetime.now()
-                note.save()
-
-
-@app.on(events.NewMessage(func=lambda e: e.is_private, incoming=True))
-@app.on(events.MessageEdited(func=lambda e: e.is_private, incoming=True))
-async def handle_user_message(event):
-    """Handles new private messages from users."""
-    event.user, create_new_topic = storage.Users.get_or_create(
-        user_id=event.sender_id)
-
-    if event.user.topic_id:
-        result: types.messages.ForumTopics = await helper(
-            functions.channels.GetForumTopicsByIDRequest(
-                channel=config.CHAT_ID, topics=[event.user.topic_id]))
-        if not result.topics:
-            create_new_topic = True
-
-        #
-        if isinstance(result.topics[0], types.ForumTopicDeleted):
-            create_new_topic = True
-
-        elif result.topics[0].closed:
-            raise events.StopPropagation
-
-    else:
-        create_new_topic = True
-
-    if create_new_topic:
-        info = await event.get_sender()
-        title = info.first_name
-        if info.last_name:
-            title += ' ' + info.last_name
-
-        if info.username is not None:
-            title += f'(@{info.username})'
-
-        result = await helper(
-            functions.channels.CreateForumTopicRequest(
-                config.CHAT_ID, title=title, random_id=event.sender_id))
-        event.user.topic_id = result.updates[0].id
-        event.user.save()
-
-        buttons = [[
-            Button.inline('⛔️ بلاک کردن', data=f'block:{info.id}'),
-            Button.inline('🗑 حذف گفتگو', data=f'delete:{info.id}')
-        ]]
-        profile = await app.download_profile_photo(info)
-        message = (
-            f'• نام: {info.first_name} {info.last_name or ""}\n'
-            f'• شناسه: `{info.id}`\n'
-            f'• نام کاربری: {"@" + info.username if info.username else "ندارد!"}'
-        )
-
-        if info.fake:
-            message += '\n\n**⚠️ این کاربر مشکوک به جعل هویت است!**'
-
-        if info.scam:
-            message += '\n\n**⚠️ این کاربر مشکوک به کلاهبرداری است!**'
-
-        if profile:
-            result = await bot.send_file(config.CHAT_ID,
-                                         profile,
-                                         caption=message,
-                                         buttons=buttons,
-                                         reply_to=event.user.topic_id)
-        else:
-            result = await bot.send_message(config.CHAT_ID,
-                                            message=message,
-                                            buttons=buttons,
-                                            reply_to=event.user.topic_id)
-
-        await bot.pin_message(config.CHAT_ID, result)
-
-
-@app.on(events.MessageEdited(func=lambda e: e.is_private, incoming=True))
-async def handle_edit_message(event):
-    """Handles edited messages in the Conv."""
-
-    message = storage.Messages.get_or_none(user=event.user,
-                                           user_message_id=event.message.id)
-    if message:
-        if not event.message.edit_hide:
-            try:
-                await bot.edit_message(config.CHAT_ID, message.topic_message_id,
-                                       event.message.message + '\n#Edited')
-
-            except errors.MessageNotModifiedError:
-                pass
-
-
-@app.on(events.MessageEdited(func=lambda e: e.is_private))  # incoming None
-async def handle_reaction_message(event):
-    message = storage.Messages.get_or_none(user_message_id=event.message.id)
-    if message:
-        await bot(
-            functions.messages.SendReactionRequest(
-                config.CHAT_ID,
-                message.topic_message_id,
-                reaction=[e.reaction for e in event.message.reactions.results]))
-
-
-@app.on(events.MessageDeleted)
-async def handle_delete_message(event):
-    """Handles delete messages in the Conv."""
-
-    for user_message_id in event.deleted_ids:
-        message = storage.Messages.get_or_none(user_message_id=user_message_id)
-        if message:
-            try:
-                data = await helper.get_messages(config.CHAT_ID,
-                                                 ids=message.topic_message_id)
-                await bot.edit_message(config.CHAT_ID, message.topic_message_id,
-                                       data.message + '\n#Deleted')
-
-            except errors.RPCError:
-                pass
-
-            finally:
-                message.delete_instance()
-
-
-@app.on(events.NewMessage(func=lambda e: e.is_private, incoming=True))
-async def handle_new_private_message(event):
-    """Handles new private messages from specific users."""
-    if event.message.reply_to:
-        try:
-            reply_to = storage.Messages.get(
-                user_message_id=event.message.reply_to.reply_to_msg_id)
-        except peewee.DoesNotExist:
-            reply_to = event.user.topic_id
-        else:
-            reply_to = reply_to.topic_message_id
-    else:
-        reply_to = event.user.topic_id
-
-    message = await copy(bot, event, config.CHAT_ID, reply_to=reply_to)
-    storage.Messages.create(user=event.user,
-                            user_message_id=event.message.id,
-                            topic_message_id=message.id)
-
-
-@bot.on(events.NewMessage(chats=config.CHAT_ID, incoming=True))
-async def handle_new_group_message(event):
-    """Handles new incoming messages in the chat."""
-    reply_to = None
-    if event.message.reply_to:
-        try:
-            reply_to = storage.Messages.get(
-                topic_message_id=event.message.reply_to.reply_to_msg_id)
-        except peewee.DoesNotExist:
-            pass
-        else:
-            reply_to = reply_to.user_message_id
-
-    message = await copy(app, event, event.user.user_id, reply_to=reply_to)
-    storage.Messages.create(user=event.user,
-                            user_message_id=message.id,
-                            topic_message_id=event.message.id)
-
-
-@bot.on(events.MessageEdited(chats=config.CHAT_ID))
-async def handle_edit_group_message(event):
-    """Handles edited messages in the chat."""
-    message = storage.Messages.get_or_none(topic_message_id=event.message.id)
-    if message:
-
-        if not event.message.edit_hide:
-            try:
-                await app.edit_message(event.user.user_id,
-                                       message.user_message_id,
-                                       event.message.message)
-
-            except errors.MessageNotModifiedError:
-                pass
-
-
-@bot.on(
-    events.NewMessage(pattern=r'^(/start|• لغو)', func=lambda e: e.is_private))
-async def admin_start_handler(event):
-    """Handles the /start command for admins."""
-    await set_user_status(event.sender_id, enums.Status.NULL)
-    await event.reply('ادمین گرامی خوش آمدید.',
-                      buttons=[[
-                          Button.text('• لیست پیام‌ها'),
-                          Button.text('• افزودن پیام جدید', resize=True)
-                      ]])
-    raise events.StopPropagation
-
-
-@bot.on(
-    events.NewMessage(pattern=r'• لیست پیام‌ها', func=lambda e: e.is_private))
-async def notes_list_handler(event):
-    """Handles the 'لیست پیام‌ها' command for admins."""
-    await event.reply(
-        'لطفاً بر روی کلید زیر کلیک کنید و پیام مورد نظر خود را انتخاب کنید.',
-        buttons=Button.switch_inline('لیست پیام‌ها', same_peer=True))
-
-
-@bot.on(
-    events.NewMessage(
-        func=lambda e: e.is_private and e.status is enums.Status.INPUT_MESSAGE))
-async def add_new_note_handler(event):
-    """Handles adding a new note by admins."""
-    if not event.raw_text:
-        await event.reply('پیام باید به صورت متن باشد.')
-    else:
-        result = storage.Notes.create(user_id=event.sender_id,
-                                      message=event.raw_text)
-        await event.reply(f'پیام با موفقیت اضافه شد\n\n{event.raw_text}',
-                          buttons=Button.inline(
-                              '🗑 حذف', data=f'delete-note:{result.id}'))
-
-        await admin_start_handler(event)
-
-
-@bot.on(
-    events.CallbackQuery(func=lambda e: e.is_admin,
-                         pattern=r'^delete-note:(\d+)$'))
-async def delete_note_handler(event):
-    """Handles deleting a message by admins."""
-    note_id = int(event.pattern_match.group(1))
-    note = storage.Notes.get_or_none(id=note_id)
-    if note:
-        delete = await cache.get(f'delete-note:{id}')
-        if not delete:
-            await cache.setex(f'delete-note:{id}', 10, 1)
-            await event.answer(
-                'اگر مطمئن هستید که می‌خواهید پیام را حذف کنید، یک بار دیگر کلیک کنید.',
-                alert=True)
-        else:
-            note.delete_instance()
-            await cache.delete(f'delete-note:{id}')
-            await event.edit(f'**پیام با موفقیت حذف شد**\n\n{note.message}')
-
-    else:
-        await event.answer('پیام یافت نشد', alert=True)
-
-
-@bot.on(
-    events.CallbackQuery(func=lambda e: e.is_admin, pattern=r'^block:(\d+)$'))
-async def block_user_handler(event):
-    """Handles blocking a user by admins."""
-    user_id = int(event.pattern_match.group(1))
-    user = storage.Users.get_or_none(user_id=user_id)
-
-    if user:
-        delete = await cache.get(f'block-user:{user_id}')
-        if not delete:
-            await cache.setex(f'block-user:{user_id}', 10, 1)
-            await event.answer(
-                'اگر مطمئن هستید که می‌خواهید کاربر را بلاک کنید، یک بار دیگر کلیک کنید.',
-                alert=True)
-        else:
-            await cache.delete(f'block-user:{user_id}')
-            await app(functions.contacts.BlockRequest(id=user_id))
-
-            entity = await app.get_entity(user_id)
-            message = (
-                '**کاربر با موفقیت بلاک شد**\n\n'
-                f'• نام: {entity.first_name} {entity.last_name or ""}\n'
-                f'• شناسه: `{entity.id}`\n'
-                f'• نام کاربری: {"@" + entity.username if entity.username else "ندارد!"}'
-            )
-
-            if entity.fake:
-                message += '\n\n**⚠️ این کاربر مشکوک به جعل هویت است!**'
-
-            if entity.scam:
-                message += '\n\n**⚠️ این کاربر مشکوک به کلاهبرداری است!**'
-
-            buttons = [[
-                Button.inline('❌ حذف بلاک', data=f'unblock:{user_id}'),
-                Button.inline('🗑 حذف گفتگو', data=f'delete:{user_id}')
-            ]]
-            await event.edit(message, buttons=buttons)
-
-    else:
-        await event.answer('کاربر یافت نشد', alert=True)
-
-
-@bot.on(
-    events.CallbackQuery(func=lambda e: e.is_admin, pattern=r'^unblock:(\d+)$'))
-async def unblock_user_handler(event):
-    """Handles unblocking a user by admins."""
-    user_id = int(event.pattern_match.group(1))
-    user = storage.Users.get_or_none(user_id=user_id)
-
-    if user:
-        unblock = await cache.get(f'unblock-user:{user_id}')
-        if not unblock:
-            await cache.setex(f'unblock-user:{user_id}', 10, 1)
-            await event.answer(
-                'اگر مطمئن هستید که می‌خواهید کاربر را از بلاک خارج کنید، یک بار دیگر کلیک کنید.',
-                alert=True)
-        else:
-            await cache.delete(f'unblock-user:{user_id}')
-            await app(functions.contacts.UnblockRequest(id=user_id))
-            entity = await app.get_entity(user_id)
-            message = (
-                '**کاربر با موفقیت از بلاک خارج شد**\n\n'
-                f'• نام: {entity.first_name} {entity.last_name or ""}\n'
-                f'• شناسه: `{entity.id}`\n'
-                f'• نام کاربری: {"@" + entity.username if entity.username else "ندارد!"}'
-            )
-
-            if entity.fake:
-                message += '\n\n**⚠️ این کاربر مشکوک به جعل هویت است!**'
-
-            if entity.scam:
-                message += '\n\n**⚠️ این کاربر مشکوک به کلاهبرداری است!**'
-
-            buttons = [[
-                Button.inline('⛔️ بلاک کردن', data=f'block:{user_id}'),
-                Button.inline('🗑 حذف گفتگو', data=f'delete:{user_id}')
-            ]]
-            await event.edit(message, buttons=buttons)
-
-    else:
-        await event.answer('کاربر یافت نشد', alert=True)
-
-
-@bot.on(
-    events.CallbackQuery(func=lambda e: e.is_admin, pattern=r'^delete:(\d+)$'))
-async def delete_conversation_handler(event):
-    """Handles deleting a conversation by admins."""
-    user_id = int(event.pattern_match.group(1))
-    user = storage.Users.get_or_none(user_id=user_id)
-
-    if user:
-        delete = await cache.get(f'delete-conversation:{user_id}')
-        if not delete:
-            await cache.setex(f'delete-conversation:{user_id}', 10, 1)
-            await event.answer(
-                'اگر مطمئن هستید که می‌خواهید گفتگو را حذف کنید، یک بار دیگر کلیک کنید.',
-                alert=True)
-        else:
-            await cache.delete(f'delete-conversation:{user_id}')
-            await app(
-                functions.messages.DeleteHistoryRequest(peer=user_id,
-                                                        max_id=0,
-                                                        just_clear=False,
-                                                        revoke=True))
-            if user.topic_id:
-                await helper(
-                    functions.channels.DeleteTopicHistoryRequest(
-                        config.CHAT_ID, top_msg_id=user.topic_id))
-            entity = await app.get_entity(user_id)
-
-            message = (
-                '**گفتگو با موفقیت حذف شد**\n\n'
-                f'• نام: {entity.first_name} {entity.last_name or ""}\n'
-                f'• شناسه: `{entity.id}`\n'
-                f'• نام کاربری: {"@" + entity.username if entity.username else "ندارد!"}'
-            )
-
-            if entity.fake:
-                message += '\n\n**⚠️ این کاربر مشکوک به جعل هویت است!**'
-            if entity.scam:
-                message += '\n\n**⚠️ این کاربر مشکوک به کلاهبرداری است!**'
-
-            await bot.send_message(config.CHAT_ID, message)
-    else:
-        await event.answer('کاربر یافت نشد', alert=True)
-
-
-@bot.on(
-    events.NewMessage(pattern='• افزودن پیام جدید',
-                      func=lambda e: e.is_private and e.is_admin))
-async def add_new_message_handler(event):
-    """Handles the 'افزودن پیام جدید' command for admins."""
-    await set_user_status(event.sender_id, enums.Status.INPUT_MESSAGE)
-    await event.reply('لطفاً پیام مورد نظر خود را ارسال کنید.',
-                      buttons=Button.text('• لغو', resize=True))
-
-
-@helper.on(events.MessageDeleted(chats=config.CHAT_ID))
-async def handle_delete_group_message(event):
-    """Handles deleted messages in the chat."""
-    for topic_message_id in event.deleted_ids:
-        message = storage.Messages.get_or_none(
-            topic_message_id=topic_message_id)
-        if message:
-            try:
-                await app.delete_messages(message.user.user_id,
-                                          message.user_message_id)
-
-            except errors.RPCError:
-                pass
-            finally:
-                message.delete_instance()
-
-
-def main():
-    bot.start(lambda: input('bot token: '))
-    app.start(lambda: input('phone number (main): '))
-
-    if config.ANONYMOUS_MODE:
-        helper.start(lambda: input('phone number (helper): '))
-
-    return app.run_until_disconnected()
-
-if __name__ == '__main__':
-    main()
-
+import os
+import asyncio
+import logging
+import sqlite3
+import functools
+import datetime
+import typing as t
+
+import peewee
+from telethon import (TelegramClient, Button, errors, types, functions, events,
+                      utils)
+
+import config
+from gadgets import (storage, enums, admins, topics, media, notes, profiles,
+                     scheduler, singleflight, pipeline, metrics, catchup,
+                     edits, reactions, albums, retention, broadcast)
+from gadgets import cache as cache_layer
+from gadgets.cache import cache, get_user_status, set_user_status
+from gadgets.dispatcher import dispatcher
+
+logging.basicConfig(level=logging.WARNING)
+if not os.path.exists('.telegram-session'):
+    os.makedirs('.telegram-session')
+
+
+def open_client(name: str) -> TelegramClient:
+    session = f'.telegram-session/{name}'
+    worker = config.PIPELINE_MODE == 'worker'
+    client = TelegramClient(
+        f'{session}-worker-{config.PIPELINE_WORKER_ID}' if worker else session,
+        api_id=config.API_ID,
+        api_hash=config.API_HASH,
+        receive_updates=not worker)
+    if worker and os.path.exists(f'{session}.session'):
+        # Workers get their updates from the streams, but log in on their
+        # own: one auth key used by several processes at once is revoked
+        # (AUTH_KEY_DUPLICATED). Only the entities the ingest knows, their
+        # access hashes, are copied over.
+        with sqlite3.connect(client.session.filename) as target:
+            target.execute('ATTACH DATABASE ? AS ingest',
+                           (f'{session}.session', ))
+            target.execute('INSERT OR REPLACE INTO entities '
+                           'SELECT * FROM ingest.entities')
+
+    return client
+
+
+bot = open_client('bot')
+app = open_client('app')
+
+if config.ANONYMOUS_MODE:
+    helper = open_client('helper')
+
+else:
+    helper = app
+
+# Outbound calls go through a scheduler per client, which handles FloodWait
+# itself; Telethon only sleeps through short ones, for the calls made right
+# on events (replies, answers) and the like.
+rpc = {}
+for name, client in (('bot', bot), ('app', app), ('helper', helper)):
+    if client in rpc:
+        continue  # helper is app
+
+    client.flood_sleep_threshold = config.RPC_FLOOD_SLEEP
+    rpc[client] = scheduler.Scheduler(
+        client, config.RPC_RATE_BOT if client is bot else config.RPC_RATE,
+        config.RPC_PEER_RATE, name)
+
+
+async def copy(sender: TelegramClient, event, target: int,
+               reply_to: t.Optional[int]):
+    file = None
+    if isinstance(event.media,
+                  (types.MessageMediaPhoto, types.MessageMediaDocument)):
+        file = await media.cached(sender, event.message)
+        if file is not None:
+            try:
+                message = await rpc[sender].relay.send_message(
+                    target,
+                    event.message.message,
+                    file=file,
+                    reply_to=reply_to)
+                metrics.media_copies.inc('cached')
+                return message
+
+            except (errors.FileReferenceExpiredError, errors.MediaEmptyError,
+                    errors.MediaInvalidError):
+                await media.forget(sender, event.message)
+                file = None
+
+        file = await upload(sender, event.message, target)
+
+    return await send(sender, event, target, reply_to, file)
+
+
+async def send(sender: TelegramClient, event, target: int,
+               reply_to: t.Optional[int], file):
+    """Sends `event` with its already resolved `file`."""
+    message = await rpc[sender].relay.send_message(target,
+                                                   event.message.message,
+                                                   file=file,
+                                                   reply_to=reply_to)
+    if file is not None:
+        await media.remember(sender, event.message, message)
+
+    return message
+
+
+async def upload(sender: TelegramClient, message, target: int):
+    """Gets the media of `message` over to `sender`, bypassing the cache."""
+    file = None
+    if sender is app and helper is app and message.chat_id == config.CHAT_ID:
+        # app is a member of CHAT_ID too (unless the helper stands in for
+        # it there) and can resend by reference.
+        file = await media.reuse(rpc[app].relay, config.CHAT_ID, message.id)
+        if file is not None:
+            metrics.media_copies.inc('reused')
+
+    if file is None:
+        file = await rpc[sender].call(scheduler.Priority.RELAY, target,
+                                      media.relay,
+                                      bot if sender is app else app, sender,
+                                      message)
+        metrics.media_copies.inc('relayed')
+
+    return file
+
+
+async def copy_album(sender: TelegramClient, parts: list, target: int,
+                     reply_to: t.Optional[int]) -> list:
+    """Like `copy`, but sends the parts of an album as one album again."""
+    if len(parts) == 1:
+        return [await copy(sender, parts[0], target, reply_to)]
+
+    messages = [part.message for part in parts]
+    captions = [message.message for message in messages]
+    files = await asyncio.gather(*(media.cached(sender, message)
+                                   for message in messages))
+    if all(file is not None for file in files):
+        try:
+            sent = await rpc[sender].relay.send_file(target,
+                                                     files,
+                                                     caption=captions,
+                                                     reply_to=reply_to)
+            metrics.media_copies.inc('cached', amount=len(files))
+            return sent
+
+        except (errors.FileReferenceExpiredError, errors.MediaEmptyError,
+                errors.MediaInvalidError):
+            for message in messages:
+                await media.forget(sender, message)
+
+            files = [None] * len(messages)
+
+    async def resolve(file, message):
+        return file if file is not None else await upload(
+            sender, message, target)
+
+    files = await asyncio.gather(*map(resolve, files, messages))
+    if any(file is None for file in files):
+        # Too large to relay, so they go as they would on their own, with
+        # the files already resolved.
+        return [
+            await send(sender, part, target, reply_to, file)
+            for part, file in zip(parts, files)
+        ]
+
+    sent = await rpc[sender].relay.send_file(target,
+                                             files,
+                                             caption=captions,
+                                             reply_to=reply_to)
+    for message, result in zip(messages, sent):
+        await media.remember(sender, message, result)
+
+    return sent
+
+
+async def relay_gathered(relay: t.Callable[[list], t.Awaitable], parts: list):
+    """Relays what `albums.gather` held back, an album or message at a time."""
+    for album in albums.split(parts):
+        await relay(album)
+
+
+def conversation(event):
+    """Returns the dispatcher key of the conversation an event is part of."""
+    if isinstance(event, events.MessageDeleted.Event):
+        return 'deleted', event.chat_id
+
+    if event.is_private:
+        return 'user', event.chat_id
+
+    reply_to = event.message.reply_to
+    if reply_to is None:
+        return 'topic', None
+
+    return 'topic', reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+
+
+@bot.on(events.NewMessage)
+@bot.on(events.InlineQuery)
+@bot.on(events.CallbackQuery)
+async def private_messages(event):
+    if event.sender_id in {802959264}:
+        event.is_admin = True
+    
+    else:
+        event.is_admin = await admins.is_admin(rpc[bot].relay,
+                                               event.sender_id)
+
+    if event.is_private:
+        if not event.is_admin:
+            raise events.StopPropagation
+
+        event.status = await get_user_status(event.sender_id)
+
+
+@bot.on(events.ChatAction(chats=config.CHAT_ID,
+                           func=lambda e: e.user_joined or e.user_added or
+                           e.user_left or e.user_kicked))
+async def handle_participants_change(event):
+    """Keeps the admin snapshot in sync with joins and leaves."""
+    await admins.participants_changed(event)
+
+
+@app.on(events.Raw((types.UpdateUserName, types.UpdateUser)))
+async def handle_user_update(event):
+    """Drops the cached profile of users who changed it."""
+    await profiles.invalidate(event.user_id)
+
+
+@bot.on(
+    events.NewMessage(chats=config.CHAT_ID,
+                      func=lambda e: isinstance(
+                          e.message.action, (types.MessageActionTopicCreate,
+                                             types.MessageActionTopicEdit))))
+async def handle_topic_service_message(event):
+    """Keeps the topic state cache current."""
+    await topics.service_message(event)
+    raise events.StopPropagation
+
+
+@bot.on(events.NewMessage(chats=config.CHAT_ID))
+@bot.on(events.MessageEdited(chats=config.CHAT_ID))
+@dispatcher.ordered(conversation)
+async def handle_group_message(event):
+    """Handles new, edited, and deleted messages in the chat."""
+    reply_to = event.message.reply_to
+    if reply_to is None or not reply_to.forum_topic:
+        raise events.StopPropagation
+
+    try:
+        event.user = await storage.run(
+            storage.Users.get,
+            topic_id=reply_to.reply_to_top_id or reply_to.reply_to_msg_id)
+
+    except peewee.DoesNotExist:
+        await event.reply('این تاپیک نامعتبر است، لطفاً تاپیک را ببندید.')
+        raise events.StopPropagation
+
+
+@bot.on(events.InlineQuery(func=lambda e: e.is_admin))
+async def show_notes_handler(event):
+    page, next_offset = await notes.search(event.original_update.query,
+                                           event.original_update.offset)
+
+    result = []
+    for note_id, message in page:
+        result.append(
+            event.builder.article(message[:50],
+                                  description=message,
+                                  text=f'/note-{note_id}'))
+
+    if result:
+        await event.answer(result, cache_time=0, next_offset=next_offset)
+
+
+@bot.on(events.NewMessage(pattern=r'^/note-(\d+)', func=lambda e: e.is_admin))
+@dispatcher.ordered(conversation)
+async def handle_note_message(event):
+    if event.via_bot_id:
+        note_id = int(event.pattern_match.group(1))
+        note = await storage.run(storage.Notes.get_or_none, id=note_id)
+        if note:
+            if event.is_private:
+                await event.reply(note.message,
+                                  buttons=Button.inline(
+                                      '🗑 حذف', data=f'delete-note:{note_id}'))
+
+            else:
+                event.raw_text = note.message
+                await notes.used(note_id)
+
+
+async def create_topic(event, stale_topic_id: t.Optional[int]):
+    """Opens a topic for the sender of `event` and returns their Users row."""
+    user = await storage.run(storage.Users.get_by_id, event.user.id)
+    if user.topic_id != stale_topic_id:
+        # Another handler or process has just opened it.
+        return user
+
+    info = await event.get_sender()
+    profile = await profiles.get(rpc[app].relay, info.id, info)
+    result = await rpc[helper].relay(
+        functions.messages.CreateForumTopicRequest(
+            config.CHAT_ID, title=profile['title'], random_id=event.sender_id))
+    user.topic_id = result.updates[0].id
+    await storage.run(user.save)
+    await topics.set_state(user.topic_id, enums.TopicState.OPEN)
+
+    buttons = [[
+        Button.inline('⛔️ بلاک کردن', data=f'block:{info.id}'),
+        Button.inline('🗑 حذف گفتگو', data=f'delete:{info.id}')
+    ]]
+    result = await profiles.send_card(rpc[bot].relay,
+                                      rpc[app].relay,
+                                      info.id,
+                                      profile,
+                                      buttons=buttons,
+                                      reply_to=user.topic_id)
+
+    await rpc[bot].relay.pin_message(config.CHAT_ID, result)
+    return user
+
+
+async def open_topic(event) -> bool:
+    """Sets `event.user`, opening a topic if needed; False if it is closed."""
+    event.user, create_new_topic = await storage.run(
+        storage.Users.get_or_create, user_id=event.sender_id)
+
+    if event.user.topic_id:
+        state = await topics.get_state(rpc[helper].relay, event.user.topic_id)
+        if state is enums.TopicState.DELETED:
+            create_new_topic = True
+
+        elif state is enums.TopicState.CLOSED:
+            return False
+
+    else:
+        create_new_topic = True
+
+    if create_new_topic:
+        event.user = await singleflight.run(
+            f'topic:{event.sender_id}',
+            lambda: create_topic(event, event.user.topic_id))
+
+    return True
+
+
+@app.on(events.NewMessage(func=lambda e: e.is_private, incoming=True))
+@app.on(events.MessageEdited(func=lambda e: e.is_private, incoming=True))
+@dispatcher.ordered(conversation)
+async def handle_user_message(event):
+    """Handles new private messages from users."""
+    if not await open_topic(event):
+        raise events.StopPropagation
+
+
+@app.on(events.MessageEdited(func=lambda e: e.is_private, incoming=True))
+@dispatcher.ordered(conversation)
+async def handle_edit_message(event):
+    """Handles edited messages in the Conv."""
+
+    message = await storage.get_message_by_user(event.sender_id,
+                                                event.message.id)
+    if message:
+        if not event.message.edit_hide:
+            topic_message_id = message.topic_message_id
+            edits.mirror(
+                config.CHAT_ID, topic_message_id, event.message.message,
+                lambda text: rpc[bot].mirror.edit_message(
+                    config.CHAT_ID, topic_message_id, text + '\n#Edited'))
+
+
+@app.on(events.MessageEdited(func=lambda e: e.is_private))  # incoming None
+@dispatcher.ordered(conversation)
+async def handle_reaction_message(event):
+    """Mirrors the reactions of users to the topic, once they change."""
+    message = await storage.get_message_by_user(event.chat_id,
+                                                event.message.id)
+    if message:
+        topic_message_id = message.topic_message_id
+        edits.mirror(config.CHAT_ID,
+                     topic_message_id,
+                     reactions.pack(reactions.theirs(event.message.reactions)),
+                     lambda value: rpc[bot].reaction(
+                         functions.messages.SendReactionRequest(
+                             config.CHAT_ID,
+                             topic_message_id,
+                             reaction=reactions.unpack(value))),
+                     kind='reaction',
+                     assumed=reactions.pack([]))
+
+
+# Deletions in private chats carry no chat, unlike the ones in channels.
+@app.on(events.MessageDeleted(func=lambda e: e.chat_id is None))
+@dispatcher.ordered(conversation)
+async def handle_delete_message(event):
+    """Handles delete messages in the Conv."""
+    messages = await storage.find_messages(event.deleted_ids)
+    if not messages:
+        return
+
+    edits.discard(config.CHAT_ID,
+                  [message.topic_message_id for message in messages])
+
+    try:
+        topic_messages = await rpc[helper].mirror.get_messages(
+            config.CHAT_ID,
+            ids=[message.topic_message_id for message in messages])
+
+    except errors.RPCError:
+        topic_messages = []
+
+    slots = asyncio.Semaphore(config.DELETE_EDIT_CONCURRENCY)
+
+    async def mark_deleted(topic_message):
+        async with slots:
+            try:
+                await rpc[bot].mirror.edit_message(
+                    config.CHAT_ID, topic_message.id,
+                    topic_message.message + '\n#Deleted')
+
+            except errors.RPCError:
+                pass
+
+    await asyncio.gather(*(mark_deleted(topic_message)
+                           for topic_message in topic_messages
+                           if topic_message is not None))
+    await storage.delete_messages(messages)
+
+
+@app.on(events.NewMessage(func=lambda e: e.is_private, incoming=True))
+@dispatcher.ordered(conversation)
+async def handle_new_private_message(event):
+    """Handles new private messages from specific users."""
+    key = conversation(event)
+    if not albums.gather(
+            key, event, lambda parts: dispatcher.submit(
+                key, lambda: relay_gathered(relay_private, parts))):
+        await relay_private([event])
+
+
+async def relay_private(parts: list):
+    """Relays a private message, or the parts of an album, to the topic."""
+    if await catchup.overlaps(parts[0].message.date):
+        parts = [
+            part for part in parts if not await storage.get_message_by_user(
+                part.sender_id, part.message.id)
+        ]
+        if not parts:
+            return
+
+    event = parts[0]
+    if event.message.reply_to:
+        reply_to = await storage.get_message_by_user(
+            event.sender_id, event.message.reply_to.reply_to_msg_id)
+        if reply_to:
+            reply_to = reply_to.topic_message_id
+        else:
+            reply_to = event.user.topic_id
+    else:
+        reply_to = event.user.topic_id
+
+    sent = await copy_album(bot, parts, config.CHAT_ID, reply_to=reply_to)
+    if len(sent) == 1:
+        await storage.create_message(event.user, event.message.id, sent[0].id)
+
+    else:
+        await storage.create_messages(
+            event.user,
+            [(part.message.id, message.id)
+             for part, message in zip(parts, sent)])
+
+
+@bot.on(events.NewMessage(chats=config.CHAT_ID, incoming=True))
+@dispatcher.ordered(conversation)
+async def handle_new_group_message(event):
+    """Handles new incoming messages in the chat."""
+    key = conversation(event)
+    if not albums.gather(
+            key, event, lambda parts: dispatcher.submit(
+                key, lambda: relay_gathered(relay_group, parts))):
+        await relay_group([event])
+
+
+async def relay_group(parts: list):
+    """Relays a topic message, or the parts of an album, to the user."""
+    if await catchup.overlaps(parts[0].message.date):
+        parts = [
+            part for part in parts
+            if not await storage.get_message_by_topic(part.message.id)
+        ]
+        if not parts:
+            return
+
+    event = parts[0]
+    reply_to = None
+    if event.message.reply_to:
+        reply_to = await storage.get_message_by_topic(
+            event.message.reply_to.reply_to_msg_id, event.user.user_id)
+        if reply_to:
+            reply_to = reply_to.user_message_id
+
+    sent = await copy_album(app, parts, event.user.user_id, reply_to=reply_to)
+    if len(sent) == 1:
+        await storage.create_message(event.user, sent[0].id, event.message.id)
+
+    else:
+        await storage.create_messages(
+            event.user,
+            [(message.id, part.message.id)
+             for part, message in zip(parts, sent)])
+
+
+@bot.on(events.MessageEdited(chats=config.CHAT_ID))
+@dispatcher.ordered(conversation)
+async def handle_edit_group_message(event):
+    """Handles edited messages in the chat."""
+    message = await storage.get_message_by_topic(event.message.id,
+                                                 event.user.user_id)
+    if message:
+
+        if not event.message.edit_hide:
+            user_id, user_message_id = (event.user.user_id,
+                                        message.user_message_id)
+            edits.mirror(
+                user_id, user_message_id, event.message.message,
+                lambda text: rpc[app].mirror.edit_message(
+                    user_id, user_message_id, text))
+
+
+@bot.on(events.Raw(types.UpdateBotMessageReaction))
+async def handle_group_reaction(update):
+    """Mirrors the reactions of admins to the user, once they change."""
+    if utils.get_peer_id(update.peer) != config.CHAT_ID:
+        return
+
+    message = await storage.get_message_by_topic(update.msg_id)
+    if message is None:
+        return
+
+    user_id, user_message_id = message.user.user_id, message.user_message_id
+    edits.mirror(user_id,
+                 user_message_id,
+                 reactions.pack(await reactions.admin_reacted(update)),
+                 lambda value: rpc[app].reaction(
+                     functions.messages.SendReactionRequest(
+                         user_id, user_message_id,
+                         reaction=reactions.unpack(value))),
+                 kind='reaction',
+                 assumed=reactions.pack([]))
+
+
+@bot.on(
+    events.NewMessage(pattern=r'^(/start|• لغو)', func=lambda e: e.is_private))
+async def admin_start_handler(event):
+    """Handles the /start command for admins."""
+    await set_user_status(event.sender_id, enums.Status.NULL)
+    await event.reply('ادمین گرامی خوش آمدید.',
+                      buttons=[[
+                          Button.text('• لیست پیام‌ها'),
+                          Button.text('• افزودن پیام جدید', resize=True)
+                      ], [Button.text('• ارسال همگانی')]])
+    raise events.StopPropagation
+
+
+@bot.on(
+    events.NewMessage(pattern=r'• لیست پیام‌ها', func=lambda e: e.is_private))
+async def notes_list_handler(event):
+    """Handles the 'لیست پیام‌ها' command for admins."""
+    await event.reply(
+        'لطفاً بر روی کلید زیر کلیک کنید و پیام مورد نظر خود را انتخاب کنید.',
+        buttons=Button.switch_inline('لیست پیام‌ها', same_peer=True))
+
+
+@bot.on(
+    events.NewMessage(
+        func=lambda e: e.is_private and e.status is enums.Status.INPUT_MESSAGE))
+async def add_new_note_handler(event):
+    """Handles adding a new note by admins."""
+    if not event.raw_text:
+        await event.reply('پیام باید به صورت متن باشد.')
+    else:
+        result = await storage.run(storage.Notes.create,
+                                   user_id=event.sender_id,
+                                   message=event.raw_text)
+        await notes.invalidate()
+        await event.reply(f'پیام با موفقیت اضافه شد\n\n{event.raw_text}',
+                          buttons=Button.inline(
+                              '🗑 حذف', data=f'delete-note:{result.id}'))
+
+        await admin_start_handler(event)
+
+
+@bot.on(
+    events.CallbackQuery(func=lambda e: e.is_admin,
+                         pattern=r'^delete-note:(\d+)$'))
+async def delete_note_handler(event):
+    """Handles deleting a message by admins."""
+    note_id = int(event.pattern_match.group(1))
+    note = await storage.run(storage.Notes.get_or_none, id=note_id)
+    if note:
+        delete = await cache.get(f'delete-note:{id}')
+        if not delete:
+            await cache.setex(f'delete-note:{id}', 10, 1)
+            await event.answer(
+                'اگر مطمئن هستید که می‌خواهید پیام را حذف کنید، یک بار دیگر کلیک کنید.',
+                alert=True)
+        else:
+            await storage.run(note.delete_instance)
+            await notes.invalidate()
+            await cache.delete(f'delete-note:{id}')
+            await event.edit(f'**پیام با موفقیت حذف شد**\n\n{note.message}')
+
+    else:
+        await event.answer('پیام یافت نشد', alert=True)
+
+
+@bot.on(
+    events.CallbackQuery(func=lambda e: e.is_admin, pattern=r'^block:(\d+)$'))
+async def block_user_handler(event):
+    """Handles blocking a user by admins."""
+    user_id = int(event.pattern_match.group(1))
+    user = await storage.run(storage.Users.get_or_none, user_id=user_id)
+
+    if user:
+        delete = await cache.get(f'block-user:{user_id}')
+        if not delete:
+            await cache.setex(f'block-user:{user_id}', 10, 1)
+            await event.answer(
+                'اگر مطمئن هستید که می‌خواهید کاربر را بلاک کنید، یک بار دیگر کلیک کنید.',
+                alert=True)
+        else:
+            await cache.delete(f'block-user:{user_id}')
+            await rpc[app].moderation(
+                functions.contacts.BlockRequest(id=user_id))
+
+            profile = await profiles.get(rpc[app].moderation, user_id)
+            message = '**کاربر با موفقیت بلاک شد**\n\n' + profile['card']
+
+            buttons = [[
+                Button.inline('❌ حذف بلاک', data=f'unblock:{user_id}'),
+                Button.inline('🗑 حذف گفتگو', data=f'delete:{user_id}')
+            ]]
+            await event.edit(message, buttons=buttons)
+
+    else:
+        await event.answer('کاربر یافت نشد', alert=True)
+
+
+@bot.on(
+    events.CallbackQuery(func=lambda e: e.is_admin, pattern=r'^unblock:(\d+)$'))
+async def unblock_user_handler(event):
+    """Handles unblocking a user by admins."""
+    user_id = int(event.pattern_match.group(1))
+    user = await storage.run(storage.Users.get_or_none, user_id=user_id)
+
+    if user:
+        unblock = await cache.get(f'unblock-user:{user_id}')
+        if not unblock:
+            await cache.setex(f'unblock-user:{user_id}', 10, 1)
+            await event.answer(
+                'اگر مطمئن هستید که می‌خواهید کاربر را از بلاک خارج کنید، یک بار دیگر کلیک کنید.',
+                alert=True)
+        else:
+            await cache.delete(f'unblock-user:{user_id}')
+            await rpc[app].moderation(
+                functions.contacts.UnblockRequest(id=user_id))
+            profile = await profiles.get(rpc[app].moderation, user_id)
+            message = '**کاربر با موفقیت از بلاک خارج شد**\n\n' + profile['card']
+
+            buttons = [[
+                Button.inline('⛔️ بلاک کردن', data=f'block:{user_id}'),
+                Button.inline('🗑 حذف گفتگو', data=f'delete:{user_id}')
+            ]]
+            await event.edit(message, buttons=buttons)
+
+    else:
+        await event.answer('کاربر یافت نشد', alert=True)
+
+
+@bot.on(
+    events.CallbackQuery(func=lambda e: e.is_admin, pattern=r'^delete:(\d+)$'))
+async def delete_conversation_handler(event):
+    """Handles deleting a conversation by admins."""
+    user_id = int(event.pattern_match.group(1))
+    user = await storage.run(storage.Users.get_or_none, user_id=user_id)
+
+    if user:
+        delete = await cache.get(f'delete-conversation:{user_id}')
+        if not delete:
+            await cache.setex(f'delete-conversation:{user_id}', 10, 1)
+            await event.answer(
+                'اگر مطمئن هستید که می‌خواهید گفتگو را حذف کنید، یک بار دیگر کلیک کنید.',
+                alert=True)
+        else:
+            await cache.delete(f'delete-conversation:{user_id}')
+            await rpc[app].moderation(
+                functions.messages.DeleteHistoryRequest(peer=user_id,
+                                                        max_id=0,
+                                                        just_clear=False,
+                                                        revoke=True))
+            if user.topic_id:
+                await rpc[helper].moderation(
+                    functions.messages.DeleteTopicHistoryRequest(
+                        config.CHAT_ID, top_msg_id=user.topic_id))
+            await storage.purge_messages(user)
+            profile = await profiles.get(rpc[app].moderation, user_id)
+            message = '**گفتگو با موفقیت حذف شد**\n\n' + profile['card']
+
+            await rpc[bot].moderation.send_message(config.CHAT_ID, message)
+    else:
+        await event.answer('کاربر یافت نشد', alert=True)
+
+
+@bot.on(
+    events.NewMessage(pattern='• افزودن پیام جدید',
+                      func=lambda e: e.is_private and e.is_admin))
+async def add_new_message_handler(event):
+    """Handles the 'افزودن پیام جدید' command for admins."""
+    await set_user_status(event.sender_id, enums.Status.INPUT_MESSAGE)
+    await event.reply('لطفاً پیام مورد نظر خود را ارسال کنید.',
+                      buttons=Button.text('• لغو', resize=True))
+
+
+@bot.on(
+    events.NewMessage(pattern='• ارسال همگانی',
+                      func=lambda e: e.is_private and e.is_admin))
+async def new_broadcast_handler(event):
+    """Handles the 'ارسال همگانی' command for admins."""
+    await set_user_status(event.sender_id, enums.Status.INPUT_BROADCAST)
+    await event.reply('لطفاً پیامی که باید برای همه کاربران ارسال شود را بفرستید.',
+                      buttons=Button.text('• لغو', resize=True))
+
+
+@bot.on(
+    events.NewMessage(func=lambda e: e.is_private and e.status is enums.Status.
+                      INPUT_BROADCAST))
+async def input_broadcast_handler(event):
+    """Handles the message admins want to broadcast."""
+    total = await storage.run(storage.Users.select().count)
+    await event.reply(
+        f'این پیام برای {total} کاربر ارسال شود؟',
+        buttons=Button.inline('📣 ارسال', data=f'broadcast:{event.id}'))
+
+    await admin_start_handler(event)
+
+
+@bot.on(
+    events.CallbackQuery(func=lambda e: e.is_admin,
+                         pattern=r'^broadcast:(\d+)$'))
+async def start_broadcast_handler(event):
+    """Handles starting a broadcast by admins."""
+    if await broadcast.active():
+        await event.answer('یک ارسال همگانی در حال انجام است.', alert=True)
+        return
+
+    await event.edit(buttons=None)
+    report = await event.respond('ارسال همگانی آغاز شد...',
+                                 buttons=Button.inline(
+                                     '⏹ توقف', data='broadcast-cancel'))
+    message_id = int(event.pattern_match.group(1))
+    if await broadcast.start(event.chat_id, message_id, report.id):
+        asyncio.ensure_future(
+            broadcast.run(prepare_broadcast, report_broadcast))
+
+    else:
+        await report.delete()
+
+
+@bot.on(
+    events.CallbackQuery(func=lambda e: e.is_admin,
+                         pattern=r'^broadcast-cancel$'))
+async def cancel_broadcast_handler(event):
+    """Handles stopping a broadcast by admins."""
+    await broadcast.cancel()
+    await event.answer('ارسال همگانی متوقف می‌شود.')
+
+
+async def prepare_broadcast(chat_id: int, message_id: int):
+    message = await rpc[bot].background.get_messages(chat_id, ids=message_id)
+    if message is None:
+        return None
+
+    has_media = isinstance(
+        message.media, (types.MessageMediaPhoto, types.MessageMediaDocument))
+    uploading = asyncio.Lock()
+
+    async def deliver(user_id: int, file):
+        return await rpc[app].broadcast.send_message(
+            user_id,
+            message.message,
+            formatting_entities=message.entities,
+            file=file)
+
+    async def send(user_id: int):
+        if not has_media:
+            await deliver(user_id, None)
+            return
+
+        # The first send uploads the media for every other one to reuse.
+        async with uploading:
+            file = await media.cached(app, message)
+            if file is None:
+                file = await upload(app, message, user_id)
+                sent = await deliver(user_id, file)
+                await media.remember(app, message, sent)
+                return
+
+        try:
+            await deliver(user_id, file)
+
+        except (errors.FileReferenceExpiredError, errors.MediaEmptyError,
+                errors.MediaInvalidError):
+            await media.forget(app, message)
+            await send(user_id)
+
+    return send
+
+
+async def report_broadcast(chat_id: int, report_id: int, progress: dict):
+    stopped = {
+        'gone': 'پیام یافت نشد.',
+        'cancelled': 'ارسال متوقف شد.',
+        'flood': 'تلگرام ارسال را محدود کرد؛ بعداً دوباره تلاش کنید.',
+    }
+    title = 'ارسال همگانی به پایان رسید' if progress[
+        'done'] else 'ارسال همگانی در حال انجام است'
+    text = (f'**{title}**\n\n'
+            f'ارسال شده: {progress["sent"]} از {progress["total"]}\n'
+            f'ناموفق: {progress["failed"]}\n'
+            f'رد شده (بلاک یا حذف حساب): {progress["skipped"]}\n'
+            f'سرعت: {progress["rate"]:.1f} پیام در ثانیه')
+    if progress['error']:
+        text += '\n\n' + stopped[progress['error']]
+
+    try:
+        await rpc[bot].background.edit_message(
+            chat_id,
+            report_id,
+            text,
+            buttons=None if progress['done'] else Button.inline(
+                '⏹ توقف', data='broadcast-cancel'))
+
+    except errors.MessageNotModifiedError:
+        pass
+
+
+@helper.on(events.MessageDeleted(chats=config.CHAT_ID))
+@dispatcher.ordered(conversation)
+async def handle_delete_group_message(event):
+    """Handles deleted messages in the chat."""
+    await topics.messages_deleted(event.deleted_ids)
+    messages = await storage.find_topic_messages(event.deleted_ids)
+
+    peers = {}
+    for message in messages:
+        peers.setdefault(message.user.user_id,
+                         []).append(message.user_message_id)
+
+    for user_id, user_message_ids in peers.items():
+        edits.discard(user_id, user_message_ids)
+        try:
+            await rpc[app].mirror.delete_messages(user_id, user_message_ids)
+
+        except errors.RPCError:
+            pass
+
+    await storage.delete_messages(messages)
+
+
+def as_event(client: TelegramClient, message) -> events.NewMessage.Event:
+    """Wraps a fetched message in the event it would have arrived as."""
+    event = events.NewMessage.Event(message)
+    event._entities = {
+        utils.get_peer_id(entity): entity
+        for entity in (message.sender, message.chat) if entity is not None
+    }
+    event._set_client(client)
+    return event
+
+
+async def catch_up_user(user_id: int, messages):
+    """Relays what a user wrote while the bot was away, in order."""
+    relayed = {
+        message.user_message_id
+        for message in await storage.find_messages(
+            [message.id for message in messages])
+    }
+    messages = [message for message in messages if message.id not in relayed]
+    if not messages:
+        return
+
+    event = as_event(app, messages[0])
+    if not await open_topic(event):
+        return
+
+    user = event.user
+    sent = {}  # user message ID -> topic message ID, of this batch
+    try:
+        for part in albums.split([as_event(app, m) for m in messages]):
+            message = part[0].message
+            reply_to = user.topic_id
+            if message.reply_to:
+                reply_id = message.reply_to.reply_to_msg_id
+                if reply_id in sent:
+                    reply_to = sent[reply_id]
+
+                else:
+                    mapping = await storage.get_message_by_user(
+                        user_id, reply_id)
+                    if mapping:
+                        reply_to = mapping.topic_message_id
+
+            results = await copy_album(bot, part, config.CHAT_ID,
+                                       reply_to=reply_to)
+            for event, result in zip(part, results):
+                sent[event.message.id] = result.id
+
+    finally:
+        await storage.create_messages(user, list(sent.items()))
+
+
+async def catch_up_topic(topic_id: int, messages):
+    """Relays what admins wrote in a topic while the bot was away, in order."""
+    user = await storage.run(storage.Users.get_or_none, topic_id=topic_id)
+    if user is None:
+        return
+
+    relayed = {
+        message.topic_message_id
+        for message in await storage.find_topic_messages(
+            [message.id for message in messages])
+    }
+    sent = {}  # topic message ID -> user message ID, of this batch
+    try:
+        messages = [m for m in messages if m.id not in relayed]
+        for part in albums.split([as_event(helper, m) for m in messages]):
+            message = part[0].message
+            reply_to = None
+            reply_id = message.reply_to.reply_to_msg_id
+            if reply_id in sent:
+                reply_to = sent[reply_id]
+
+            elif reply_id != topic_id:
+                mapping = await storage.get_message_by_topic(
+                    reply_id, user.user_id)
+                if mapping:
+                    reply_to = mapping.user_message_id
+
+            results = await copy_album(app, part, user.user_id,
+                                       reply_to=reply_to)
+            for event, result in zip(part, results):
+                sent[event.message.id] = result.id
+
+    finally:
+        await storage.create_messages(
+            user, [(user_message_id, topic_message_id)
+                   for topic_message_id, user_message_id in sent.items()])
+
+
+async def catch_up(since: datetime.datetime, until: datetime.datetime):
+    """Relays everything written while the bot was away, in bulk.
+
+    Missed messages are read from history rather than replayed update by
+    update: topic states are refreshed in batches, every conversation is
+    relayed in order on the dispatcher, ahead of the live updates held
+    back meanwhile, and its mappings are stored in one transaction.
+    """
+    own_ids = set()
+    for client in {bot, app, helper}:
+        own_ids.add((await client.get_me(input_peer=True)).user_id)
+
+    private = await catchup.missed_private(app, since, until)
+    group = await catchup.missed_group(helper, since, until, own_ids)
+
+    users = await storage.run(
+        list,
+        storage.Users.select(storage.Users.topic_id).where(
+            storage.Users.user_id.in_(list(private)),
+            storage.Users.topic_id.is_null(False)))
+    topic_ids = sorted({user.topic_id for user in users} | set(group))
+    for index in range(0, len(topic_ids), topics.BATCH_SIZE):
+        await topics.fetch(rpc[helper].background,
+                           topic_ids[index:index + topics.BATCH_SIZE])
+
+    jobs = [
+        dispatcher.enqueue(('user', user_id),
+                           functools.partial(catch_up_user, user_id, messages))
+        for user_id, messages in private.items()
+    ] + [
+        dispatcher.enqueue(('topic', topic_id),
+                           functools.partial(catch_up_topic, topic_id,
+                                             messages))
+        for topic_id, messages in group.items()
+    ]
+    # Every missed conversation is queued first, so live updates can go.
+    dispatcher.release()
+    for result in await asyncio.gather(*jobs, return_exceptions=True):
+        if isinstance(result, Exception):
+            logging.error('catching up a conversation failed', exc_info=result)
+
+
+def main():
+    storage.init()
+    catching_up = config.PIPELINE_MODE == 'inline' or (
+        config.PIPELINE_MODE == 'worker' and config.PIPELINE_WORKER_ID == 0)
+    if catching_up:
+        app.loop.run_until_complete(catchup.hold())
+
+    bot.start(lambda: input('bot token: '))
+    app.start(lambda: input('phone number (main): '))
+
+    if config.ANONYMOUS_MODE:
+        helper.start(lambda: input('phone number (helper): '))
+
+    clients = {'bot': bot, 'app': app}
+    if config.ANONYMOUS_MODE:
+        clients['helper'] = helper
+
+    app.loop.create_task(metrics.serve())
+    if config.PIPELINE_MODE == 'ingest':
+        pipeline.ingest(clients)
+        return app.run_until_disconnected()
+
+    for client in clients.values():
+        metrics.instrument(client)
+
+    app.loop.create_task(cache_layer.listen_forever())
+    app.loop.create_task(admins.refresh_forever(helper))
+    app.loop.create_task(topics.reconcile_forever(rpc[helper].background))
+    app.loop.create_task(notes.store_forever())
+    if config.PIPELINE_MODE == 'worker':
+        app.loop.create_task(pipeline.work(clients))
+
+    if catching_up:
+        app.loop.create_task(catchup.run(catch_up))
+        app.loop.create_task(retention.run_forever())
+        app.loop.create_task(broadcast.run(prepare_broadcast, report_broadcast))
+
+    return app.run_until_disconnected()
+
+if __name__ == '__main__':
+    main()
+